@@ -0,0 +1,181 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+cur_dir = os.path.dirname(__file__)
+
+# CSR over outgoing edges (rows = from_address) and CSC over incoming edges (rows = to_address);
+# both point into the per-edge arrays (from_address, to_address, value, count) by edge id
+adjacency_arrays = ['out_indptr', 'out_edge', 'in_indptr', 'in_edge', 'from_address', 'to_address', 'value', 'count']
+
+
+def adjacency_path(start_date, end_date):
+    return os.path.join(cur_dir, "data", f"adj_{start_date}_{end_date}")
+
+
+def build_adjacency(edges, num_nodes=None):
+    """
+    Builds outgoing and incoming compressed sparse row indices from the create_edges output.
+
+    :param edges: DataFrame with from_address, to_address (address ids), value and count
+    :param num_nodes: number of address ids, inferred from the edges if None
+    :return: dict of numpy arrays, see adjacency_arrays
+    """
+    src = edges['from_address'].to_numpy(dtype=np.int64)
+    dst = edges['to_address'].to_numpy(dtype=np.int64)
+    if num_nodes is None:
+        num_nodes = int(max(src.max(initial=-1), dst.max(initial=-1))) + 1
+
+    adj = {'from_address': src.astype(np.int32),
+           'to_address': dst.astype(np.int32),
+           'value': edges['value'].to_numpy(dtype=np.float64),
+           'count': edges['count'].to_numpy(dtype=np.int64)}
+    for prefix, rows in [('out', src), ('in', dst)]:
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        adj[f'{prefix}_indptr'] = indptr
+        adj[f'{prefix}_edge'] = np.argsort(rows, kind="stable").astype(np.int64)
+    return adj
+
+
+def merge_adjacency(adj, new_edges, num_nodes=None):
+    """
+    Adds the aggregated edges of a new batch to an adjacency index without rebuilding it. The
+    result is the index build_adjacency gives for create_graph.update_edges(edges, new_edges):
+    value and count are added for pairs already present, and the other pairs get new edge ids
+    after the existing ones.
+
+    :return: the merged index and the names of the arrays that changed
+    """
+    keys = ['from_address', 'to_address']
+    new_edges = new_edges.groupby(keys, as_index=False)[['value', 'count']].sum()
+    src = new_edges['from_address'].to_numpy(dtype=np.int64)
+    dst = new_edges['to_address'].to_numpy(dtype=np.int64)
+    num_nodes = max(num_nodes or 0, num_adjacency_nodes(adj), int(max(src.max(initial=-1), dst.max(initial=-1))) + 1)
+
+    # edge ids of the pairs already present, looked up among the out edges of the batch sources
+    edge_ids, neighbors = node_edges(adj, np.unique(src), 'out')
+    old_keys = np.asarray(adj['from_address'][edge_ids], dtype=np.int64) * num_nodes + neighbors
+    order = np.argsort(old_keys)
+    new_keys = src * num_nodes + dst
+    pos = np.minimum(np.searchsorted(old_keys[order], new_keys), max(len(order) - 1, 0))
+    found = old_keys[order][pos] == new_keys if len(order) else np.zeros(len(new_keys), dtype=bool)
+    matched = edge_ids[order[pos[found]]]
+
+    merged = dict(adj)
+    merged['value'] = np.array(adj['value'])
+    merged['count'] = np.array(adj['count'])
+    merged['value'][matched] += new_edges['value'].to_numpy(dtype=np.float64)[found]
+    merged['count'][matched] += new_edges['count'].to_numpy(dtype=np.int64)[found]
+    changed = ['value', 'count']
+    if found.all() and num_nodes == num_adjacency_nodes(adj):
+        return merged, changed
+
+    added = ~found
+    num_edges = len(adj['from_address'])
+    new_ids = np.arange(num_edges, num_edges + added.sum(), dtype=np.int64)
+    merged['from_address'] = np.concatenate([adj['from_address'], src[added].astype(np.int32)])
+    merged['to_address'] = np.concatenate([adj['to_address'], dst[added].astype(np.int32)])
+    merged['value'] = np.concatenate([merged['value'], new_edges['value'].to_numpy(dtype=np.float64)[added]])
+    merged['count'] = np.concatenate([merged['count'], new_edges['count'].to_numpy(dtype=np.int64)[added]])
+    for prefix, rows in [('out', src[added]), ('in', dst[added])]:
+        indptr = np.asarray(adj[f'{prefix}_indptr'])
+        indptr = np.concatenate([indptr, np.full(num_nodes + 1 - len(indptr), indptr[-1], dtype=np.int64)])
+        # new edges go after the existing edges of their node, as with the stable sort of build_adjacency
+        row_order = np.argsort(rows, kind="stable")
+        merged[f'{prefix}_edge'] = np.insert(np.asarray(adj[f'{prefix}_edge']), indptr[rows[row_order] + 1],
+                                             new_ids[row_order])
+        merged[f'{prefix}_indptr'] = indptr + np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_nodes))])
+    return merged, adjacency_arrays
+
+
+def save_adjacency(adj, path, names=adjacency_arrays):
+    # each array is replaced atomically, a server reading the index never sees a partial file
+    os.makedirs(path, exist_ok=True)
+    for name in names:
+        tmp_path = os.path.join(path, f"{name}.npy.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, adj[name])
+        os.replace(tmp_path, os.path.join(path, f"{name}.npy"))
+
+
+def load_adjacency(path, mmap=True):
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in adjacency_arrays}
+
+
+def adjacency_exists(path):
+    return all(os.path.isfile(os.path.join(path, f"{name}.npy")) for name in adjacency_arrays)
+
+
+def load_or_build_adjacency(edges, path, num_nodes=None):
+    if adjacency_exists(path):
+        return load_adjacency(path)
+    adj = build_adjacency(edges, num_nodes)
+    save_adjacency(adj, path)
+    return adj
+
+
+def num_adjacency_nodes(adj):
+    return len(adj['out_indptr']) - 1
+
+
+def node_edges(adj, nodes, direction='out'):
+    """
+    Returns the ids of the edges leaving (direction='out') or entering (direction='in') the
+    given nodes, together with the neighbour at the other end of each edge.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    nodes = nodes[(nodes >= 0) & (nodes < num_adjacency_nodes(adj))]
+    indptr = adj[f'{direction}_indptr']
+    starts, ends = indptr[nodes], indptr[nodes + 1]
+    lengths = ends - starts
+    # concatenation of the ranges [start, end) without a python loop
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    edge_ids = np.asarray(adj[f'{direction}_edge'][positions])
+    neighbors = adj['to_address' if direction == 'out' else 'from_address'][edge_ids]
+    return edge_ids, np.asarray(neighbors, dtype=np.int64)
+
+
+def ego_edges(adj, node, n=2, direction='out'):
+    """
+    Collects the edge ids of the n-hop ego graph of node.
+
+    The root contributes its incoming and outgoing edges. Its neighbours along direction
+    ('out', 'in' or 'both') form the first frontier, and every further hop adds the edges of
+    the frontier along direction, up to n hops from the root.
+    """
+    assert direction in ['out', 'in', 'both'], 'Invalid direction'
+    directions = ['out', 'in'] if direction == 'both' else [direction]
+
+    edge_list = []
+    frontier = np.empty(0, dtype=np.int64)
+    for d in ['out', 'in']:
+        edge_ids, neighbors = node_edges(adj, [node], d)
+        edge_list.append(edge_ids)
+        if d in directions:
+            frontier = np.concatenate([frontier, neighbors])
+
+    visited = {node}
+    for _ in range(n - 1):
+        frontier = np.unique(frontier)
+        frontier = np.array([i for i in frontier.tolist() if i not in visited], dtype=np.int64)
+        if len(frontier) == 0:
+            break
+        visited.update(frontier.tolist())
+        next_frontier = []
+        for d in directions:
+            edge_ids, neighbors = node_edges(adj, frontier, d)
+            edge_list.append(edge_ids)
+            next_frontier.append(neighbors)
+        frontier = np.concatenate(next_frontier)
+
+    edge_ids = np.concatenate(edge_list)
+    _, first = np.unique(edge_ids, return_index=True)
+    return edge_ids[np.sort(first)]
+
+
+def edges_frame(adj, edge_ids):
+    return pd.DataFrame({name: np.asarray(adj[name][edge_ids])
+                         for name in ['from_address', 'to_address', 'value', 'count']})
@@ -3,6 +3,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from tx_store import load_transactions
+
 
 def iqr_outliers(data):
     q1, q3 = np.nanquantile(data, [0.25, 0.75])
@@ -55,9 +57,7 @@ def run():
     if not os.path.exists(figures_path):
         os.makedirs(figures_path)
 
-    data_path = os.path.join("data", "eth_data.csv")
-    data_df = pd.read_csv(data_path, parse_dates=["block_timestamp"], index_col=0,
-                          usecols=['Unnamed: 0', 'hash', 'from_address', 'to_address', 'value', 'block_timestamp'])
+    data_df = load_transactions(['hash', 'from_address', 'to_address', 'value', 'block_timestamp'])
     data_df = data_df.set_index("block_timestamp")
 
     plot_time(data_df, figures_path)
@@ -0,0 +1,260 @@
+import os
+import time
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+
+def squared_distances(A, B, B_sq_norms=None):
+    # ||a - b||^2 for all pairs, without materializing the differences
+    if B_sq_norms is None:
+        B_sq_norms = np.einsum("ij,ij->i", B, B)
+    dist = np.einsum("ij,ij->i", A, A)[:, None] - 2 * A @ B.T + B_sq_norms[None, :]
+    return np.maximum(dist, 0)
+
+
+def euclidean_rows(X, rows, query_vec):
+    return np.sqrt(squared_distances(query_vec[None, :], np.asarray(X[rows], dtype=np.float32))[0])
+
+
+def assign_lists(X, centroids, chunksize=65536):
+    c_sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(X.shape[0], dtype=np.int32)
+    for start in range(0, X.shape[0], chunksize):
+        chunk = np.asarray(X[start:start + chunksize], dtype=np.float32)
+        labels[start:start + chunksize] = squared_distances(chunk, centroids, c_sq_norms).argmin(axis=1)
+    return labels
+
+
+def build_ivf_index(X, n_lists=None, n_iter=10, sample_size=100_000, seed=0):
+    """
+    Builds an inverted-file index: k-means centroids over a sample of the embeddings and, for
+    every centroid, the rows assigned to it.
+
+    :param X: embedding matrix (can be memory-mapped)
+    :param n_lists: number of centroids, about sqrt(N) if None
+    :param n_iter: k-means iterations
+    :param sample_size: number of rows the centroids are trained on
+    :return: dict with centroids, list_indptr and list_indices
+    """
+    rng = np.random.default_rng(seed)
+    num_rows = X.shape[0]
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(num_rows)))
+    n_lists = min(n_lists, num_rows)
+
+    sample_idx = np.sort(rng.choice(num_rows, min(sample_size, num_rows), replace=False))
+    sample = np.asarray(X[sample_idx], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in tqdm(range(n_iter), desc="k-means"):
+        labels = assign_lists(sample, centroids)
+        counts = np.bincount(labels, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # restart empty lists from random sample points
+        centroids[empty] = sample[rng.choice(len(sample), empty.sum(), replace=False)]
+
+    labels = assign_lists(X, centroids)
+    list_indptr = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_lists), out=list_indptr[1:])
+    list_indices = np.argsort(labels, kind="stable").astype(np.int64)
+    return {"centroids": centroids, "list_indptr": list_indptr, "list_indices": list_indices}
+
+
+def ivf_index_path(embedding_file):
+    return embedding_file[:-len(".npy")] + "_ivf.npz"
+
+
+def embedding_stamp(embedding_file, num_rows):
+    # identifies the embeddings an index is built from, retrained embeddings are written under the same name
+    st = os.stat(embedding_file)
+    return {"num_rows": np.int64(num_rows), "source_size": np.int64(st.st_size),
+            "source_mtime_ns": np.int64(st.st_mtime_ns)}
+
+
+def save_index(index, path, stamp=None):
+    np.savez(path, **index, **(stamp or {}))
+
+
+def load_index(path, stamp=None):
+    """
+    :param stamp: embedding_stamp of the current embeddings; None is returned if the index was built
+                  from other embeddings
+    """
+    with np.load(path) as f:
+        index = {name: f[name] for name in f.files}
+    if stamp is not None and any(name not in index or index[name] != value for name, value in stamp.items()):
+        return None
+    return index
+
+
+def search_ivf(index, X, query_vec, top_k, n_probe=8, exclude_idx=None):
+    """
+    Approximate euclidean top-k: only the rows in the n_probe lists closest to the query are
+    compared exactly. More probes give higher recall at higher latency.
+
+    :return: indices and distances sorted by distance, as get_neighbors
+    """
+    if len(index["list_indices"]) != X.shape[0]:
+        raise ValueError("The IVF index was built from other embeddings")
+    query_vec = np.asarray(query_vec, dtype=np.float32)[None, :]
+    n_probe = min(n_probe, len(index["centroids"]))
+    centroid_dist = squared_distances(query_vec, index["centroids"])[0]
+    probes = np.argpartition(centroid_dist, n_probe - 1)[:n_probe]
+
+    indptr, indices = index["list_indptr"], index["list_indices"]
+    candidates = np.sort(np.concatenate([indices[indptr[p]:indptr[p + 1]] for p in probes]))
+    if exclude_idx is not None:
+        candidates = candidates[candidates != exclude_idx]
+    if len(candidates) == 0:
+        return [], []
+
+    dist = euclidean_rows(X, candidates, query_vec[0])
+    k = min(top_k, len(candidates))
+    top = np.argpartition(dist, k - 1)[:k]
+    top = top[np.argsort(dist[top], kind="stable")]
+    return candidates[top].tolist(), dist[top].tolist()
+
+
+def quantize_embeddings(X, kind="int8", chunksize=65536):
+    """
+    Compact copy of the embeddings for candidate search. x is approximated by offset + scale * code:
+    float16 keeps the values as half precision, int8 maps every dimension's [min, max] to 256 levels.
+
+    :return: dict with codes, offset, scale and the squared norms of the approximated rows
+    """
+    assert kind in ["int8", "float16"], 'Invalid quantization'
+    num_rows, dim = X.shape
+    if kind == "float16":
+        offset, scale = np.zeros(dim, dtype=np.float32), np.ones(dim, dtype=np.float32)
+    else:
+        lo = np.full(dim, np.inf, dtype=np.float32)
+        hi = np.full(dim, -np.inf, dtype=np.float32)
+        for start in range(0, num_rows, chunksize):
+            chunk = np.asarray(X[start:start + chunksize], dtype=np.float32)
+            lo, hi = np.minimum(lo, chunk.min(axis=0)), np.maximum(hi, chunk.max(axis=0))
+        scale = np.maximum(hi - lo, 1e-12) / 255
+        offset = lo + 128 * scale  # codes are centred on zero to fit int8
+
+    codes = np.empty((num_rows, dim), dtype=np.int8 if kind == "int8" else np.float16)
+    code_sq_norms = np.empty(num_rows, dtype=np.float32)
+    for start in range(0, num_rows, chunksize):
+        chunk = np.asarray(X[start:start + chunksize], dtype=np.float32)
+        if kind == "int8":
+            chunk_codes = np.clip(np.rint((chunk - offset) / scale), -128, 127).astype(np.int8)
+        else:
+            chunk_codes = chunk.astype(np.float16)
+        codes[start:start + chunksize] = chunk_codes
+        scaled = chunk_codes.astype(np.float32) * scale
+        code_sq_norms[start:start + chunksize] = np.einsum("ij,ij->i", scaled, scaled)
+    return {"codes": codes, "offset": offset, "scale": scale, "code_sq_norms": code_sq_norms}
+
+
+def quantized_path(embedding_file, kind="int8"):
+    return embedding_file[:-len(".npy")] + f"_{kind}.npz"
+
+
+def search_quantized(quantized, X, query_vec, top_k, rerank=10, exclude_idx=None, chunksize=8192):
+    """
+    Euclidean top-k in two passes: approximate distances to every row are computed on the codes,
+    then the rerank * top_k closest rows are re-ranked with the original vectors in X.
+
+    :return: indices and distances sorted by distance, as get_neighbors
+    """
+    codes, scale = quantized["codes"], quantized["scale"]
+    if codes.shape[0] != X.shape[0]:
+        raise ValueError("The quantized embeddings were built from other embeddings")
+    # ||q - offset - scale * c||^2 = ||q'||^2 - 2 (q' * scale) . c + ||scale * c||^2
+    query_vec = np.asarray(query_vec, dtype=np.float32) - quantized["offset"]
+    query_scaled = query_vec * scale
+    approx = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], chunksize):
+        chunk = codes[start:start + chunksize].astype(np.float32)
+        approx[start:start + chunksize] = quantized["code_sq_norms"][start:start + chunksize] - 2 * chunk @ query_scaled
+    if exclude_idx is not None:
+        approx[exclude_idx] = np.inf
+
+    num_candidates = min(rerank * top_k, codes.shape[0] - (exclude_idx is not None))
+    if num_candidates <= 0:
+        return [], []
+    candidates = np.sort(np.argpartition(approx, num_candidates - 1)[:num_candidates])
+    dist = euclidean_rows(X, candidates, query_vec + quantized["offset"])
+    k = min(top_k, len(candidates))
+    top = np.argpartition(dist, k - 1)[:k]
+    top = top[np.argsort(dist[top], kind="stable")]
+    return candidates[top].tolist(), dist[top].tolist()
+
+
+def recall_at_k(search, X, query_idx, top_k=10):
+    """
+    Compares an approximate search against exact search for the given query rows.
+
+    :param search: function (idx, top_k) -> (indices, distances) excluding idx itself
+    :return: mean recall@k, mean exact latency and mean approximate latency in seconds
+    """
+    X_sq_norms = np.einsum("ij,ij->i", X, X)
+    recalls, exact_time, ann_time = [], 0., 0.
+    for idx in query_idx:
+        t = time.time()
+        dist = squared_distances(np.asarray(X[idx:idx + 1], dtype=np.float32), X, X_sq_norms)[0]
+        dist[idx] = np.inf
+        exact = set(np.argpartition(dist, top_k - 1)[:top_k].tolist())
+        exact_time += time.time() - t
+
+        t = time.time()
+        approx, _ = search(idx, top_k)
+        ann_time += time.time() - t
+        recalls.append(len(exact.intersection(approx)) / top_k)
+    return float(np.mean(recalls)), exact_time / len(query_idx), ann_time / len(query_idx)
+
+
+if __name__ == '__main__':
+    from model_helper import embedding_file, load_embedding
+
+    parser = argparse.ArgumentParser(description="Build the IVF index or the quantized embeddings and report their recall")
+    parser.add_argument("--quantize", choices=["int8", "float16"], default=None,
+                        help="build quantized embeddings instead of the IVF index")
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--n-iter", type=int, default=10)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--n-queries", type=int, default=200)
+    args = parser.parse_args()
+
+    X, _ = load_embedding()
+    stamp = embedding_stamp(embedding_file, X.shape[0])
+    path = quantized_path(embedding_file, args.quantize) if args.quantize else ivf_index_path(embedding_file)
+    index = None
+    if os.path.isfile(path):
+        index = load_index(path, stamp)
+        if index is None:
+            print(f"{path} was built from other embeddings, rebuilding it")
+    if index is not None:
+        print(f"Loading {path}")
+    elif args.quantize:
+        index = quantize_embeddings(X, kind=args.quantize)
+        save_index(index, path, stamp)
+        print(f"Saved {path}")
+    else:
+        index = build_ivf_index(X, n_lists=args.n_lists, n_iter=args.n_iter)
+        save_index(index, path, stamp)
+        print(f"Saved {path}")
+
+    X = np.asarray(X, dtype=np.float32)
+    query_idx = np.random.default_rng(0).choice(X.shape[0], min(args.n_queries, X.shape[0]), replace=False)
+    if args.quantize:
+        print(f"{args.quantize} codes: {index['codes'].nbytes / 2 ** 20:.1f}MB vs {X.nbytes / 2 ** 20:.1f}MB, "
+              f"recall@{args.top_k} over {len(query_idx)} queries")
+        for rerank in [1, 2, 5, 10, 20]:
+            search = lambda idx, k: search_quantized(index, X, X[idx], k, rerank=rerank, exclude_idx=idx)
+            recall, exact_time, ann_time = recall_at_k(search, X, query_idx, args.top_k)
+            print(f"rerank={rerank:3d}  recall={recall:.3f}  exact={exact_time * 1e3:.2f}ms  quantized={ann_time * 1e3:.2f}ms")
+    else:
+        print(f"{len(index['centroids'])} lists, recall@{args.top_k} over {len(query_idx)} queries")
+        for n_probe in [1, 2, 4, 8, 16, 32, 64]:
+            if n_probe > len(index["centroids"]):
+                break
+            search = lambda idx, k: search_ivf(index, X, X[idx], k, n_probe=n_probe, exclude_idx=idx)
+            recall, exact_time, ann_time = recall_at_k(search, X, query_idx, args.top_k)
+            print(f"n_probe={n_probe:3d}  recall={recall:.3f}  exact={exact_time * 1e3:.2f}ms  ivf={ann_time * 1e3:.2f}ms")
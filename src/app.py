@@ -1,13 +1,25 @@
 import os
-import glob
-import shutil
-import pickle
+import time
+import threading
+import functools
+import urllib.parse
+import contextlib
+import flask
 import pandas as pd
 import numpy as np
-from dash import Dash, Input, Output, dcc, html, State
+import networkx as nx
+from dash import Dash, Input, Output, dcc, html, State, ctx
 from dash.exceptions import PreventUpdate
 import plotly.express as px
-from model_helper import query_topk, load_embedding
+from model_helper import query_topk, load_address_index, load_classifier, score_address, score_addresses
+from tx_store import data_version, timestamp_range, store_exists
+from callback_cache import CallbackCache, code_version
+from autocomplete import build_prefix_index, prefix_matches
+from artifacts import artifact_digest, artifact_response
+from time_cube import (load_activity, build_time_series, date_slice, build_address_cube, address_time_series, build_fingerprints,
+                       minmax_downsample)
+from adjacency import adjacency_path, adjacency_exists, load_adjacency, load_or_build_adjacency
+from plot_graph import write_graph_json, get_subgraph, load_preds
 
 
 freq_map = {
@@ -18,26 +30,112 @@ freq_map = {
 
 cur_dir = os.path.dirname(__file__)
 
-# load data
-data = (pd.read_csv(os.path.join(cur_dir, "data/eth_data.csv"), parse_dates=["block_timestamp"], index_col=0)
-        .set_index("block_timestamp"))
-addr_data = pd.read_csv(os.path.join(cur_dir, "data/address_data.csv"), index_col=0)
-id2addr = addr_data["address"].to_dict()
-addr2id = {v: k for k, v in id2addr.items()}
-
-# put the html files inside assets folder
-for html_path in glob.glob(os.path.join(cur_dir, "outputs", "selections", "*.html")):
-    dest_path = os.path.join(cur_dir, "assets", os.path.basename(html_path))
-    shutil.copy(html_path, dest_path)
-
-
-if not os.path.exists(os.path.join(cur_dir, "assets", "lib")):
-    if not os.path.exists("lib"):
-        raise RuntimeError("The lib directory is not found.")
-    else:
-        shutil.copytree("lib", "assets/lib")
-        print("The lib/ directory is put under assets/")
-
+# results of the slower chart callbacks, shared by the server processes and invalidated by new data or code
+callback_cache = CallbackCache(version=f"{data_version()}-{code_version()}")
+
+# points per trace sent to the browser, longer series are downsampled to the zoomed range
+max_plot_points = 2000
+
+# graph pages, written by plot_graph.py and by the app itself into outputs/app
+outputs_dir = os.path.join(cur_dir, "outputs")
+render_dir = os.path.join(outputs_dir, "app")
+os.makedirs(render_dir, exist_ok=True)
+
+# the window of the edges the ego graphs are built from
+graph_start_date = "2017-06-22"
+graph_end_date = "2022-03-01"
+
+# the data and indexes are loaded by load_state, on a background thread when the app is run directly,
+# so the server answers right away; /ready reports when they are loaded and how long each phase took
+startup = {"ready": threading.Event(), "timings": {}, "error": None}
+tx_hours = tx_index = time_series = address_cube = fingerprints = None
+addr_data = id2addr = addr2id = address_prefix_index = pair2ids = adj = graph_preds = None
+
+# the date picker bounds only need the first and last timestamp, read from meta.json at import when
+# there is a store and set by load_state otherwise, as the csv would have to be loaded for them
+date_range_picker = dcc.DatePickerRange(id="date-range")
+
+
+def set_date_bounds(first_timestamp, last_timestamp):
+    date_range_picker.min_date_allowed = date_range_picker.start_date = first_timestamp.date()
+    date_range_picker.max_date_allowed = date_range_picker.end_date = last_timestamp.date()
+
+
+if store_exists():
+    set_date_bounds(*timestamp_range())
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    start_time = time.time()
+    yield
+    startup["timings"][name] = round(time.time() - start_time, 3)
+    print(f"Loaded {name} in {startup['timings'][name]:.1f}s")
+
+
+def load_state():
+    global tx_hours, tx_index, time_series, address_cube, fingerprints
+    global addr_data, id2addr, addr2id, address_prefix_index, pair2ids, adj, graph_preds
+    try:
+        with startup_phase("transactions"):
+            # hour of each transaction and the rows sent and received by each address
+            tx_hours, tx_index = load_activity()
+        with startup_phase("time series"):
+            # hourly transaction counts, globally and per address, rolled up to days and months
+            time_series = build_time_series(tx_hours)
+            if not store_exists() and len(tx_hours):
+                set_date_bounds(*pd.DatetimeIndex(time_series["H"][0][[0, -1]]))
+            address_cube = {d: build_address_cube(tx_hours, tx_index[f"{d}_indptr"], tx_index[f"{d}_rows"])
+                            for d in ["out", "in"]}
+            # 24-hour and 7-day histograms of the sent transactions of every address
+            fingerprints = build_fingerprints(address_cube["out"])
+        with startup_phase("addresses"):
+            addr_data = pd.read_csv(os.path.join(cur_dir, "data/address_data.csv"), index_col=0)
+            id2addr = addr_data["address"].to_dict()
+            addr2id = {v: k for k, v in id2addr.items()}
+            # sorted addresses for the autocomplete suggestions of the address inputs
+            address_prefix_index = build_prefix_index(addr_data["address"].values)
+            pair2ids = addr_data[addr_data["pair_idx"] != -1].groupby("pair_idx").groups
+        with startup_phase("graph"):
+            # ego graphs are rendered on request from the adjacency index
+            adj_path = adjacency_path(graph_start_date, graph_end_date)
+            if adjacency_exists(adj_path):
+                adj = load_adjacency(adj_path)
+            else:
+                edges = pd.read_csv(os.path.join(cur_dir, "data", f"edges_{graph_start_date}_{graph_end_date}.csv"),
+                                    index_col=0)
+                adj = load_or_build_adjacency(edges, adj_path, num_nodes=int(addr_data.index.max()) + 1)
+        with startup_phase("predictions"):
+            graph_preds = {}
+            for task in ["deanon", "phish"]:
+                try:
+                    graph_preds[task] = load_preds(task, "label-pred", addr_data)
+                except FileNotFoundError:
+                    print(f"No {task} predictions found, the {task} graphs are rendered without them.")
+                    graph_preds[task] = None
+        with startup_phase("classifier"):
+            # the phishing classifier stays resident, scoring a click is then a single predict_proba
+            load_classifier()
+            load_address_index()
+        startup["ready"].set()
+    except Exception as e:
+        startup["error"] = repr(e)
+        raise
+
+
+def start_loading():
+    threading.Thread(target=load_state, name="load-state", daemon=True).start()
+
+
+def after_startup(func):
+    # callbacks fired before load_state is done are skipped instead of holding a worker; the overview
+    # chart is drawn again when data-ready changes, the others on the next input
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not startup["ready"].is_set() or startup["error"] is not None:
+            raise PreventUpdate
+        return func(*args, **kwargs)
+    return wrapper
 
 external_stylesheets = [
     {
@@ -86,13 +184,7 @@ app.layout = html.Div(
                         html.Div(
                             children="Date Range", className="menu-title"
                         ),
-                        dcc.DatePickerRange(
-                            id="date-range",
-                            min_date_allowed=data.index.min().date(),
-                            max_date_allowed=data.index.max().date(),
-                            start_date=data.index.min().date(),
-                            end_date=data.index.max().date(),
-                        ),
+                        date_range_picker,
                     ]
                 ),
             ],
@@ -141,6 +233,7 @@ app.layout = html.Div(
                             type='text',
                             value='',
                             id="account-filter-1",
+                            list="address-suggestions",
                             size="40",
                             className="search-bar"
                         ),
@@ -154,6 +247,7 @@ app.layout = html.Div(
                             type='text',
                             value='',
                             id="account-filter-2",
+                            list="address-suggestions",
                             size="40",
                             className="search-bar"
                         ),
@@ -202,7 +296,7 @@ app.layout = html.Div(
         html.Div(
             style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
             children=[
-                html.Div(dcc.Input(id='input-on-submit1', type='text', placeholder="De-Anonymization Account Address")),
+                html.Div(dcc.Input(id='input-on-submit1', type='text', list="address-suggestions", placeholder="De-Anonymization Account Address")),
                 html.Button(id='add-element-button', n_clicks=0, children='Create graph',
                             style={"width": '200px'}),
             ],
@@ -240,6 +334,7 @@ app.layout = html.Div(
                             type='text',
                             value='',
                             id="account-filter-3",
+                            list="address-suggestions",
                             size="40",
                             className="search-bar"
                         ),
@@ -269,7 +364,7 @@ app.layout = html.Div(
         html.Div(
             style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
             children=[
-                html.Div(dcc.Input(id='input-on-submit3', type='text', placeholder="Phishing Account Address")),
+                html.Div(dcc.Input(id='input-on-submit3', type='text', list="address-suggestions", placeholder="Phishing Account Address")),
                 html.Button(id='add-element-button2', n_clicks=0, children='Create graph',
                             style={"width": '200px'}),
             ],
@@ -288,7 +383,7 @@ app.layout = html.Div(
         html.Div(
             style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
             children=[
-                dcc.Input(id="input-query", type="text", placeholder="Enter your query"),  # Input component for query
+                dcc.Input(id="input-query", type="text", list="address-suggestions", placeholder="Enter your query"),  # Input component for query
                 html.Div(id="output-query"),  # Output component for displaying query result
                 html.Button("Submit", id="submit-button"),  # Button component to trigger query processing
             ]
@@ -304,32 +399,77 @@ app.layout = html.Div(
         html.Div(
             style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
             children=[
-                dcc.Input(id="input-query2", type="text", placeholder="Enter your query"),  # Input component for query
+                dcc.Input(id="input-query2", type="text", list="address-suggestions", placeholder="Enter your query"),  # Input component for query
                 html.Div(id="output-query2"),  # Output component for displaying query result
                 html.Button("Submit", id="submit-button2"),  # Button component to trigger query processing
             ]
-        )
+        ),
+        html.Datalist(id="address-suggestions"),
+        # polls until load_state is done, then sets data-ready and stops
+        dcc.Interval(id="startup-poll", interval=2000),
+        dcc.Store(id="data-ready"),
     ]
 )
 
 
+@app.callback(
+    Output("data-ready", "data"),
+    Output("startup-poll", "disabled"),
+    Input("startup-poll", "n_intervals"),
+)
+def poll_startup(n_intervals):
+    if startup["error"] is not None:
+        return False, True
+    if not startup["ready"].is_set():
+        raise PreventUpdate
+    return True, True
+
+
+address_inputs = ["account-filter-1", "account-filter-2", "account-filter-3", "input-on-submit1", "input-on-submit3",
+                  "input-query", "input-query2"]
+
+
+@app.callback(
+    Output("address-suggestions", "children"),
+    [Input(input_id, "value") for input_id in address_inputs],
+)
+@after_startup
+def suggest_addresses(*values):
+    # suggestions for the input being edited, none once it holds a complete known address
+    prefix = ctx.triggered[0]["value"] if ctx.triggered else None
+    if not prefix or len(prefix) < 3 or prefix in addr2id:
+        return []
+    return [html.Option(value=address) for address in prefix_matches(address_prefix_index, prefix)]
+
+
+def known_or_empty(addr):
+    # partial addresses would only produce empty charts, so the callbacks wait for a known one
+    return not addr or addr in addr2id
+
+
 @app.callback(
     Output("time-graph", "figure"),
     Input("freq-filter", "value"),
     Input("date-range", "start_date"),
     Input("date-range", "end_date"),
+    Input("time-graph", "relayoutData"),
+    Input("data-ready", "data"),
 )
-def update_time_plot(freq, start_date, end_date):
-    fil_data = data.groupby(pd.Grouper(freq=freq)).count()
-    fil_data = fil_data.loc[(fil_data.index > start_date) & (fil_data.index < end_date)]
+@after_startup
+def update_time_plot(freq, start_date, end_date, relayout_data=None, ready=None):
+    labels, counts = time_series[freq]
+    window = date_slice(labels, start_date, end_date)
+    x_range = zoom_range(relayout_data)
+    x, y = view_series(labels[window], counts[window], x_range)
     time_plot_figure = {
         "data": [
             {
-                "x": fil_data.index,
-                "y": fil_data["hash"],
+                "x": x,
+                "y": y,
                 "type": "lines",
             },
-        ]
+        ],
+        "layout": zoom_layout(x_range),
     }
     return time_plot_figure
 
@@ -340,28 +480,34 @@ def update_time_plot(freq, start_date, end_date):
     Input("freq-filter-2", "value"),
     Input("account-filter-1", "value"),
     Input("account-filter-2", "value"),
+    Input("deanony-graph", "relayoutData"),
 )
-def update_deanony_time_plot(freq, addr_1, addr_2):
-    addr_df_1 = process_addr(addr_1, freq)
-    addr_df_2 = process_addr(addr_2, freq)
+@after_startup
+def update_deanony_time_plot(freq, addr_1, addr_2, relayout_data=None):
+    if not (known_or_empty(addr_1) and known_or_empty(addr_2)):
+        raise PreventUpdate
+    x_range = zoom_range(relayout_data)
+    x_1, y_1 = view_series(*addr_series(addr_1, freq), x_range)
+    x_2, y_2 = view_series(*addr_series(addr_2, freq), x_range)
 
     time_plot_figure = {
         "data": [
             {
-                "x": addr_df_1.index,
-                "y": addr_df_1["hash"],
+                "x": x_1,
+                "y": y_1,
                 "type": "lines",
                 "name": addr_1,
                 "marker": dict(color='rgb(55, 83, 109)'),
             },
             {
-                "x": addr_df_2.index,
-                "y": addr_df_2["hash"],
+                "x": x_2,
+                "y": y_2,
                 "type": "lines",
                 "name": addr_2,
                 "marker": dict(color='rgb(26, 118, 255)'),
             },
-        ]
+        ],
+        "layout": zoom_layout(x_range),
     }
     return time_plot_figure
 
@@ -371,12 +517,13 @@ def update_deanony_time_plot(freq, addr_1, addr_2):
     Input("account-filter-1", "value"),
     Input("account-filter-2", "value"),
 )
+@after_startup
+@callback_cache.memoize
 def update_deanony_acc_hourly_plot(addr_1, addr_2):
-    addr_df_1 = process_addr(addr_1, freq="H")
-    addr_df_2 = process_addr(addr_2, freq="H")
-
-    arr_1 = get_daily_trend(addr_df_1)
-    arr_2 = get_daily_trend(addr_df_2)
+    if not (known_or_empty(addr_1) and known_or_empty(addr_2)):
+        raise PreventUpdate
+    arr_1 = get_daily_trend(addr_1)
+    arr_2 = get_daily_trend(addr_2)
 
     account_df1 = pd.DataFrame({"time_step": np.arange(24), "tx_count": arr_1, "address": np.tile(addr_1, 24)})
     account_df2 = pd.DataFrame({"time_step": np.arange(24), "tx_count": arr_2, "address": np.tile(addr_2, 24)})
@@ -403,12 +550,13 @@ def update_deanony_acc_hourly_plot(addr_1, addr_2):
     Input("account-filter-1", "value"),
     Input("account-filter-2", "value"),
 )
+@after_startup
+@callback_cache.memoize
 def update_deanony_acc_weekly_plot(addr_1, addr_2):
-    addr_df_1 = process_addr(addr_1, freq="D")
-    addr_df_2 = process_addr(addr_2, freq="D")
-
-    arr_1 = get_weekly_trend(addr_df_1)
-    arr_2 = get_weekly_trend(addr_df_2)
+    if not (known_or_empty(addr_1) and known_or_empty(addr_2)):
+        raise PreventUpdate
+    arr_1 = get_weekly_trend(addr_1)
+    arr_2 = get_weekly_trend(addr_2)
 
     account_df1 = pd.DataFrame({"time_step": np.arange(7), "tx_count": arr_1, "address": np.tile(addr_1, 7)})
     account_df2 = pd.DataFrame({"time_step": np.arange(7), "tx_count": arr_2, "address": np.tile(addr_2, 7)})
@@ -435,22 +583,17 @@ def update_deanony_acc_weekly_plot(addr_1, addr_2):
     Input('add-element-button', 'n_clicks'),
     State('input-on-submit1', 'value'),
 )
+@after_startup
 def add_deanon_graph(n_clicks, deanon_addr):
     if n_clicks:
-        html_addr = ""
-        for html_path in glob.glob(os.path.join("assets", "deanon_label-pred_*")):
-            if str(addr2id[deanon_addr]) in html_path:
-                html_addr = html_path
-
-        element = html.Div(
-            style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
-            children=[
-                html.Iframe(src=html_addr,
-                            style={"height": "512px", "width": "1000px"}
-                            )
-            ]
-        )
-        return element
+        if deanon_addr not in addr2id:
+            return unknown_address_element(deanon_addr)
+
+        # the queried account first, then its ENS pair if it has one
+        addr_id = addr2id[deanon_addr]
+        pair_idx = addr_data.at[addr_id, "pair_idx"]
+        address_ids = [addr_id] + [i for i in pair2ids.get(pair_idx, []) if i != addr_id]
+        return graph_element(render_ego_graph("deanon", tuple(address_ids)))
     else:
         raise PreventUpdate
 
@@ -460,19 +603,25 @@ def add_deanon_graph(n_clicks, deanon_addr):
     Output("phishing-graph", "figure"),
     Input("freq-filter-3", "value"),
     Input("account-filter-3", "value"),
+    Input("phishing-graph", "relayoutData"),
 )
-def update_deanony_time_plot(freq, addr):
-    account_df = process_addr(addr, freq)
+@after_startup
+def update_deanony_time_plot(freq, addr, relayout_data=None):
+    if not known_or_empty(addr):
+        raise PreventUpdate
+    x_range = zoom_range(relayout_data)
+    x, y = view_series(*addr_series(addr, freq), x_range)
     time_plot_figure = {
         "data": [
             {
-                "x": account_df.index,
-                "y": account_df["hash"],
+                "x": x,
+                "y": y,
                 "type": "lines",
                 "name": addr,
                 "marker": dict(color='rgb(55, 83, 109)'),
             }
-        ]
+        ],
+        "layout": zoom_layout(x_range),
     }
     return time_plot_figure
 
@@ -482,30 +631,63 @@ def update_deanony_time_plot(freq, addr):
     Input('add-element-button2', 'n_clicks'),
     State('input-on-submit3', 'value'),
 )
+@after_startup
 def add_strategy_divison(n_clicks, phis_addr):
     if n_clicks:
-        html_addr = os.path.join("assets", f"phish_label-pred_{addr2id[phis_addr]}.html")
-        print(html_addr)
-        element = html.Div(
-            style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
-            children=[
-                html.Iframe(src=html_addr,
-                            style={"height": "512px", "width": "1000px"}
-                            )
-            ]
-        )
-        return element
+        if phis_addr not in addr2id:
+            return unknown_address_element(phis_addr)
+        return graph_element(render_ego_graph("phish", (addr2id[phis_addr],)))
     else:
         raise PreventUpdate
 
+
+@functools.lru_cache(maxsize=128)
+def render_ego_graph(task, address_ids):
+    # writes the graph data into outputs/app, served by the /outputs route and drawn by the shared
+    # assets/graph_viewer.html; the digest in the url lets browsers cache it for good
+    graph = nx.DiGraph()
+    for address in address_ids:
+        graph = nx.compose(get_subgraph(adj, address), graph)
+
+    preds = graph_preds[task]
+    mode = "label-pred" if preds is not None else "label"
+    tag = f"{task}_{mode}_{'_'.join(str(i) for i in address_ids)}"
+    json_path = write_graph_json(graph, addr_data, task, mode, list(address_ids), preds, tag, render_dir)
+    data_url = f"/outputs/app/{tag}.json?v={artifact_digest(json_path)[:12]}"
+    return f"/assets/graph_viewer.html?data={urllib.parse.quote(data_url, safe='/')}"
+
+
+def graph_element(html_addr):
+    return html.Div(
+        style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
+        children=[
+            html.Iframe(src=html_addr,
+                        style={"height": "512px", "width": "1000px"}
+                        )
+        ]
+    )
+
+
+def unknown_address_element(addr):
+    return html.Div(
+        style={'display': 'flex', 'justify-content': 'center', 'align-items': 'center'},
+        children=[html.P(f"Unknown address: {addr}")]
+    )
+
 @app.callback(
     Output("output-query", "children"),  # Output to display query result
     [Input("submit-button", "n_clicks")],  # Input from submit button click
     [Input("input-query", "value")],  # Input from query input field
 )
+@after_startup
 def process_query(n_clicks, query):
     output_lines = []
     if n_clicks is not None and query is not None:
+        if query not in load_address_index():
+            # typing only updates the result once the address is complete, the button reports unknown ones
+            if ctx.triggered_id == "input-query":
+                raise PreventUpdate
+            return [unknown_address_element(query)]
         # Process the query and generate the output lines
         # In this example, we simply repeat the query in ten lines
         top_address_list, top_distance_list = query_topk(query, 10)
@@ -533,30 +715,21 @@ def process_query(n_clicks, query):
     [Input("submit-button2", "n_clicks")],  # Input from submit button click
     [Input("input-query2", "value")],  # Input from query input field
 )
+@after_startup
 def process_query2(n_clicks, query):
     output_lines = []
     if n_clicks is not None and query is not None:
-        # Process the query and generate the output lines
-        X, address_list = load_embedding()
-        index = -1
-        for i in range(len(address_list)):
-            if query == address_list[i]:
-                index =i
-                break
-
-
-        # Load the saved model
-        with open('data/classifier.pkl', 'rb') as f:
-            rf_loaded = pickle.load(f)
-
-        # Use the loaded model to make predictions
-        y_test_proba = rf_loaded.predict_proba(np.expand_dims(X[index],axis=0))[:, 1]
+        score = score_address(query)
+        if score is None:
+            if ctx.triggered_id == "input-query2":
+                raise PreventUpdate
+            return [unknown_address_element(query)]
 
         output_lines.append(html.Li(
             html.Div(
                 children=[
                     html.Span("Score: ", style={"color": "red", "marginLeft": "40px"}),
-                    html.Span("{}".format(y_test_proba))  # Use Span component for black color
+                    html.Span("{}".format(score))  # Use Span component for black color
                 ]
             )
         ))
@@ -566,28 +739,93 @@ def process_query2(n_clicks, query):
     return output_lines
 
 
+@app.server.route("/api/score", methods=["POST"])
+def score_endpoint():
+    # batch scoring: {"addresses": [...]} -> {"scores": [...]}, null for unknown addresses
+    body = flask.request.get_json(force=True, silent=True)
+    addresses = body.get("addresses", []) if isinstance(body, dict) else None
+    if not isinstance(addresses, list) or not all(isinstance(address, str) for address in addresses):
+        return flask.jsonify({"error": 'expected a JSON object {"addresses": [...]} with a list of address strings'}), 400
+    scores = score_addresses(addresses)
+    return flask.jsonify({"scores": [None if np.isnan(score) else float(score) for score in scores]})
+
+
+@app.server.route("/api/cache-stats")
+def cache_stats_endpoint():
+    return flask.jsonify(callback_cache.stats())
+
+
 # some statistic function
-def process_addr(addr_str, freq="H"):
-    addr_df = data.loc[data["from_address"] == addr_str]
-    addr_df = addr_df.groupby(pd.Grouper(freq=freq)).count()
-    return addr_df
+def process_addr(addr_str, freq="H", direction="out"):
+    # transactions sent (direction="out") or received ("in") by the address per bucket, as a "hash" column
+    labels, counts = address_time_series(address_cube[direction], tx_index["address_to_code"].get(addr_str), freq)
+    return pd.DataFrame({"hash": counts}, index=pd.DatetimeIndex(labels, name="block_timestamp"))
+
+
+def addr_series(addr_str, freq="H"):
+    addr_df = process_addr(addr_str, freq)
+    return addr_df.index.values, addr_df["hash"].values
+
+
+def zoom_range(relayout_data):
+    # the x range the user zoomed to, None when the whole series is shown
+    if not relayout_data or relayout_data.get("xaxis.autorange"):
+        return None
+    if "xaxis.range[0]" in relayout_data:
+        return [relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]]
+    return relayout_data.get("xaxis.range")
+
+
+def view_series(labels, counts, x_range=None):
+    # the zoomed part of a series, plus one point on each side, downsampled to max_plot_points
+    if x_range is not None:
+        start = np.searchsorted(labels, pd.Timestamp(x_range[0]).to_datetime64(), "left")
+        stop = np.searchsorted(labels, pd.Timestamp(x_range[1]).to_datetime64(), "right")
+        labels, counts = labels[max(start - 1, 0):stop + 1], counts[max(start - 1, 0):stop + 1]
+    labels, counts = minmax_downsample(labels, counts, max_plot_points)
+    return pd.DatetimeIndex(labels), counts
+
+
+def zoom_layout(x_range):
+    return {"xaxis": {"range": x_range}} if x_range is not None else {}
+
+
+def get_daily_trend(addr_str):
+    # transactions sent by the address per hour of the day
+    code = tx_index["address_to_code"].get(addr_str)
+    return fingerprints["hourly"][code] if code is not None else np.zeros(24, dtype=np.int32)
+
+
+def get_weekly_trend(addr_str):
+    # transactions sent by the address per day of the week, Monday first
+    code = tx_index["address_to_code"].get(addr_str)
+    return fingerprints["weekly"][code] if code is not None else np.zeros(7, dtype=np.int32)
+
+
+@app.server.route("/outputs/<path:path>")
+def outputs_endpoint(path):
+    # graph pages and data files of outputs/ in place, precompressed when available; lib/ comes from assets/lib
+    roots = [outputs_dir]
+    if "lib/" in path and not os.path.isfile(os.path.join(outputs_dir, path)):
+        # folders without their own copy of lib/ share the one in assets/
+        roots, path = [os.path.join(cur_dir, "assets")], path[path.index("lib/"):]
+    return artifact_response(roots, path)
 
 
-def get_daily_trend(acc_df):
-    daily_tx_count = []
-    for time_ind in range(24):
-        idx = pd.to_datetime(acc_df.index).hour == time_ind
-        daily_tx_count.append(acc_df.loc[idx, "hash"].sum())
-    return daily_tx_count
+@app.server.route("/health")
+def health_endpoint():
+    return flask.jsonify({"status": "ok"})
 
 
-def get_weekly_trend(acc_df):
-    weekly_tx_count = []
-    for time_ind in range(7):
-        idx = pd.to_datetime(acc_df.index).dayofweek == time_ind
-        weekly_tx_count.append(acc_df.loc[idx, "hash"].sum())
-    return weekly_tx_count
+@app.server.route("/ready")
+def ready_endpoint():
+    ready = startup["ready"].is_set()
+    status = {"ready": ready, "error": startup["error"], "timings": startup["timings"]}
+    return flask.jsonify(status), 200 if ready else 503
 
 
 if __name__ == "__main__":
-    app.run_server(debug=True)
+    # with debug the reloader runs the app in a child process, only that one needs the data
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_loading()
+    app.run(debug=True)
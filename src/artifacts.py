@@ -0,0 +1,112 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+import functools
+import flask
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# graph pages and their libraries are written once and read many times, so they are compressed when
+# written and served as is; only files at least this large are worth compressing
+min_compress_size = 1024
+compressed_suffixes = {'br': '.br', 'gzip': '.gz'}
+
+
+def write_artifact(path, content):
+    # written under a temporary name of its own and renamed, so that readers (and other processes
+    # writing the same file) never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def compress_artifact(path):
+    """
+    Writes path.gz, and path.br when brotli is installed, next to path, unless they are up to date.
+    """
+    if os.path.getsize(path) < min_compress_size:
+        for suffix in compressed_suffixes.values():
+            if os.path.isfile(path + suffix):
+                os.remove(path + suffix)
+        return
+    suffixes = ['.gz'] + (['.br'] if brotli is not None else [])
+    if all(os.path.isfile(path + s) and os.path.getmtime(path + s) >= os.path.getmtime(path) for s in suffixes):
+        return
+    with open(path, 'rb') as f:
+        content = f.read()
+    # mtime=0 keeps the output identical for identical content
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content)
+    for suffix, compressed in variants.items():
+        write_artifact(path + suffix, compressed)
+
+
+def compress_tree(folder, extensions=('.html', '.js', '.css')):
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(extensions):
+                compress_artifact(os.path.join(root, name))
+
+
+def artifact_digest(path):
+    st = os.stat(path)
+    return file_digest(path, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def file_digest(path, mtime_ns, size):
+    # keyed on mtime and size, so a rewritten file gets a new digest
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def artifact_response(roots, rel_path, max_age=86400):
+    """
+    Serves rel_path from the first of roots that has it, choosing the precompressed variant the
+    client accepts, with an ETag and cache headers. Versioned URLs (with a ?v= query) are
+    cached for a year, as their content never changes.
+    """
+    request = flask.request
+    path = None
+    for root in roots:
+        candidate = safe_join(root, rel_path)
+        if candidate is not None and os.path.isfile(candidate):
+            path = candidate
+            break
+    if path is None:
+        flask.abort(404)
+
+    encoding, served_path = 'identity', path
+    for name in ['br', 'gzip']:
+        if request.accept_encodings[name] and os.path.isfile(path + compressed_suffixes[name]):
+            encoding, served_path = name, path + compressed_suffixes[name]
+            break
+
+    etag = f'"{artifact_digest(path)}-{encoding}"'
+    if request.args.get('v'):
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = f'public, max-age={max_age}'
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = flask.Response(status=304)
+    else:
+        response = flask.send_file(served_path, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                                   conditional=False, etag=False, max_age=None)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
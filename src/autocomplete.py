@@ -0,0 +1,19 @@
+import numpy as np
+
+
+def build_prefix_index(addresses):
+    # sorted copy of the addresses, the matches of a prefix are then one contiguous run
+    return np.sort(np.unique(np.asarray(addresses, dtype=str)))
+
+
+def prefix_matches(prefix_index, prefix, limit=10):
+    """
+    :return: up to limit addresses starting with prefix, in sorted order
+    """
+    start = np.searchsorted(prefix_index, prefix, side="left")
+    matches = []
+    for address in prefix_index[start:start + limit].tolist():
+        if not address.startswith(prefix):
+            break
+        matches.append(address)
+    return matches
@@ -0,0 +1,35 @@
+import csv
+import time
+import argparse
+from tqdm import tqdm
+
+from model_helper import query_topk_batch
+
+
+def run(input_path, output_path, top_k=10, block_size=4096):
+    with open(input_path, "r") as f:
+        query_addresses = [line.strip() for line in f if line.strip()]
+
+    start_time = time.time()
+    num_unknown = 0
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["query_addr", "rank", "cand_addr", "distance"])
+        results = query_topk_batch(query_addresses, top_k, block_size=block_size)
+        for query_address, top_address_list, top_distance_list in tqdm(results, total=len(query_addresses)):
+            if not top_address_list:
+                num_unknown += 1
+            for rank, (address, distance) in enumerate(zip(top_address_list, top_distance_list)):
+                writer.writerow([query_address, rank + 1, address, f"{distance:.6f}"])
+
+    print(f"{len(query_addresses)} queries in {time.time() - start_time:.1f}s, {num_unknown} without embedding")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Top-k nearest embeddings for a file of addresses")
+    parser.add_argument("input_path", help="text file with one address per line")
+    parser.add_argument("output_path", help="csv file with query_addr, rank, cand_addr, distance")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--block-size", type=int, default=4096, help="rows per block, bounds the peak memory")
+    args = parser.parse_args()
+    run(args.input_path, args.output_path, top_k=args.top_k, block_size=args.block_size)
@@ -0,0 +1,149 @@
+import os
+import glob
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+import functools
+
+
+cur_dir = os.path.dirname(__file__)
+cache_path = os.path.join(cur_dir, "data", "callback_cache.sqlite")
+# bumped when the format of the cached values changes
+cache_schema = 1
+
+
+def code_version(folder=cur_dir):
+    # digest of the app's python sources, so that results of older code are not served after an upgrade
+    h = hashlib.sha1(str(cache_schema).encode())
+    for path in sorted(glob.glob(os.path.join(folder, "*.py"))):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+class CallbackCache:
+    """
+    Size-bounded LRU cache of function results in a sqlite file, shared by every process that
+    opens the same path (e.g. the workers of one server).
+
+    Entries are keyed on the function, its arguments and the version (e.g. of the data and the
+    code), so results computed on older data or by older code are never returned and age out of
+    the cache.
+
+    Hits only read the database: their last-used times and the hit and miss counts are kept in
+    memory and written in one transaction every flush_interval seconds, or along with a miss.
+    """
+
+    def __init__(self, path=cache_path, max_entries=10_000, version="", flush_interval=5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self.flush_interval = flush_interval
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.pending_used = {}
+        self.pending_stats = {}
+        self.last_flush = time.time()
+
+    def connect(self):
+        # one connection per process, sqlite connections must not be shared across a fork
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # with WAL a crash can lose the last commits but not corrupt the file, fine for a cache
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, last_used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+            self.conn, self.pid = conn, os.getpid()
+            # updates pending in the parent belong to the parent
+            self.pending_used, self.pending_stats = {}, {}
+        return self.conn
+
+    def key(self, name, args, kwargs):
+        return hashlib.sha1(pickle.dumps((name, args, sorted(kwargs.items()), self.version))).hexdigest()
+
+    def get(self, key):
+        conn = self.connect()
+        row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        with self.lock:
+            self.pending_used[key] = time.time()
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value):
+        conn = self.connect()
+        with self.lock:
+            conn.execute("BEGIN")
+            try:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                             (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+                num_over = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+                if num_over > 0:
+                    conn.execute("DELETE FROM entries WHERE key IN "
+                                 "(SELECT key FROM entries ORDER BY last_used LIMIT ?)", (num_over,))
+                self.write_pending(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def count(self, name, hit):
+        with self.lock:
+            counts = self.pending_stats.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_pending(self, conn):
+        # called with the lock held, inside a transaction
+        conn.executemany("UPDATE entries SET last_used = MAX(last_used, ?) WHERE key = ?",
+                         [(used, key) for key, used in self.pending_used.items()])
+        conn.executemany("INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET "
+                         "hits = hits + excluded.hits, misses = misses + excluded.misses",
+                         [(name, hits, misses) for name, (hits, misses) in self.pending_stats.items()])
+        self.pending_used, self.pending_stats = {}, {}
+        self.last_flush = time.time()
+
+    def flush(self):
+        conn = self.connect()
+        with self.lock:
+            if not self.pending_used and not self.pending_stats:
+                return
+            conn.execute("BEGIN")
+            try:
+                self.write_pending(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        self.flush()
+        rows = self.connect().execute("SELECT name, hits, misses FROM stats ORDER BY name").fetchall()
+        return {name: {"hits": hits, "misses": misses} for name, hits, misses in rows}
+
+    def clear(self):
+        conn = self.connect()
+        with self.lock:
+            self.pending_used, self.pending_stats = {}, {}
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM stats")
+
+    def memoize(self, func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self.key(name, args, kwargs)
+            hit, value = self.get(key)
+            self.count(name, hit)
+            if not hit:
+                value = func(*args, **kwargs)
+                self.set(key, value)
+            return value
+        return wrapper
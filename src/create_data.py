@@ -1,35 +1,99 @@
 import os
+import glob
+import pickle
+import tempfile
+import time
 import numpy as np
 import pandas as pd
-from datetime import datetime
+from dateutil import tz
+from tqdm import tqdm
 
+from tx_store import StoreWriter, store_dir
+
+
+columns = ['hash', 'block_number', 'transaction_index', 'from_address',
+           'to_address', 'value', 'gas', 'gas_price', 'block_timestamp']
+float_columns = ["block_number", "transaction_index", "value", "gas", "gas_price"]
+dtypes = {**{col: str for col in ['hash', 'from_address', 'to_address']},
+          **{col: np.float64 for col in float_columns},
+          'block_timestamp': np.int64}
+
+
+def to_local_datetime(epochs):
+    # same wall-clock values as datetime.fromtimestamp, without the per-row python call
+    stamps = pd.to_datetime(epochs, unit="s", utc=True).dt.tz_convert(tz.tzlocal())
+    return stamps.dt.tz_localize(None).astype("datetime64[ns]")
 
-def run():
-    cur_dir = os.path.dirname(__file__)
-    data_path = os.path.join(cur_dir, "../EthereumDataset/phishing_deanony_2hop_transaction.csv")
 
-    columns = ['hash', 'block_number', 'transaction_index', 'from_address',
-               'to_address', 'value', 'gas', 'gas_price', 'block_timestamp']
-    data = []
-    with open(data_path, "r") as f:
-        for line in f.readlines():
-            data.append(line.strip().split(","))
-    data_df = pd.DataFrame(data, columns=columns)
+def read_chunks(data_path, chunksize):
+    # round_trip parsing gives bit-identical floats to float(str)
+    return pd.read_csv(data_path, header=None, names=columns, dtype=dtypes, keep_default_na=False,
+                       float_precision="round_trip", chunksize=chunksize)
 
-    for col in ["block_number", "transaction_index", "value", "gas", "gas_price"]:
-        data_df[col] = data_df[col].astype(float)
-    data_df.value /= 1e18
 
-    data_df["block_timestamp"] = data_df["block_timestamp"].astype(int)
-    data_df.sort_values("block_timestamp", inplace=True)
+def parse_chunk(chunk):
+    chunk["value"] /= 1e18
+    chunk["block_timestamp"] = to_local_datetime(chunk["block_timestamp"])
+    return chunk
+
+
+def run(chunksize=1_000_000, write_csv=False):
+    """
+    Streams the raw transaction dump into the columnar store (data/eth_store) sorted by
+    block_timestamp, optionally also exporting the legacy data/eth_data.csv.
+
+    Memory is bounded by the chunk size and the largest month: parsed chunks are spilled
+    to per-month temporary files, and each month is then sorted and appended in turn.
+    """
+    cur_dir = os.path.dirname(__file__)
+    data_path = os.path.join(cur_dir, "../EthereumDataset/phishing_deanony_2hop_transaction.csv")
+    out_dir = os.path.join(cur_dir, "data")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    start_time = time.time()
+    num_rows = 0
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        progress = tqdm(desc="Parsing", unit=" rows", unit_scale=True)
+        for chunk_idx, chunk in enumerate(read_chunks(data_path, chunksize)):
+            # months and the order within them come from the epoch, as the local wall-clock time of
+            # parse_chunk repeats an hour when DST ends
+            epochs = chunk["block_timestamp"].values.copy()
+            chunk = parse_chunk(chunk)
+            chunk["epoch"] = epochs
+            months = epochs.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+            for month, month_df in chunk.groupby(months, sort=False):
+                with open(os.path.join(tmp_dir, f"{month:06d}_{chunk_idx:06d}.pkl"), "wb") as f:
+                    pickle.dump(month_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            num_rows += len(chunk)
+            progress.update(len(chunk))
+        progress.close()
 
-    data_df["block_timestamp"] = data_df["block_timestamp"].apply(lambda x: pd.Timestamp(datetime.fromtimestamp(x)))
-    data_df.reset_index(inplace=True)
-    data_df.drop(columns=["index"], inplace=True)
+        out_path = os.path.join(out_dir, "eth_data.csv")
+        spill_paths = sorted(glob.glob(os.path.join(tmp_dir, "*.pkl")))
+        month_keys = sorted(set(os.path.basename(p).split("_")[0] for p in spill_paths))
+        writer = StoreWriter(store_dir, overwrite=True)
+        offset = 0
+        for i, month in enumerate(tqdm(month_keys, desc="Writing")):
+            month_paths = [p for p in spill_paths if os.path.basename(p).startswith(f"{month}_")]
+            month_df = pd.concat([pd.read_pickle(p) for p in month_paths])
+            month_df.sort_values("epoch", kind="stable", inplace=True)
+            month_df.drop(columns="epoch", inplace=True)
+            month_df.index = pd.RangeIndex(offset, offset + len(month_df))
+            writer.append(month_df)
+            if write_csv:
+                month_df.to_csv(out_path, mode="w" if i == 0 else "a", header=i == 0)
+            offset += len(month_df)
+            for p in month_paths:
+                os.remove(p)
+        if write_csv and not month_keys:
+            # an empty dump still gives the table with its header
+            pd.DataFrame(columns=columns).to_csv(out_path)
+        writer.sort_dictionary()
+        writer.close()
 
-    if not os.path.exists("data"):
-        os.makedirs("data")
-    data_df.to_csv(os.path.join(cur_dir, "data", "eth_data.csv"))
+    elapsed = time.time() - start_time
+    print(f"Wrote {num_rows} rows in {elapsed:.1f}s ({num_rows / max(elapsed, 1e-9):,.0f} rows/s)")
 
 
 if __name__ == '__main__':
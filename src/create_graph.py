@@ -1,24 +1,34 @@
 import os
 import json
+import shutil
+import hashlib
 import pickle as pkl
 from tqdm import tqdm
 
 import numpy as np
 import pandas as pd
-import numpy as np
+
+from tx_store import load_transactions, load_dictionary, store_exists, data_version
+from adjacency import build_adjacency, save_adjacency, adjacency_path, adjacency_exists
 
 
 cur_dir = os.path.dirname(__file__)
+edge_columns = ['from_address', 'to_address', 'value', 'count']
 
 
 def create_addresses():
-    data_path = os.path.join(cur_dir, "data", "eth_data.csv")
-    data_df = pd.read_csv(data_path, parse_dates=["block_timestamp"], index_col=0,
-                          usecols=['Unnamed: 0', 'hash', 'from_address', 'to_address', 'value', 'block_timestamp'])
+    data_df = load_transactions(['from_address', 'to_address'], decode_addresses=False)
 
     # index users without clipping data
-    nodes = np.unique(data_df["from_address"].tolist() + data_df["to_address"].tolist()).tolist()
+    nodes = np.unique(np.concatenate([data_df["from_address"].values, data_df["to_address"].values]))
+    if store_exists():
+        nodes = np.sort(load_dictionary()[nodes].astype(str))
+    nodes = nodes.tolist()
+
+    return label_addresses(nodes)
+
 
+def load_labels():
     phish_path = os.path.join(cur_dir, "../EthereumDataset", "exp_phishing_eoa.txt")
     with open(phish_path, "r") as f:
         phish_acc_list = f.read().splitlines()
@@ -35,48 +45,220 @@ def create_addresses():
     type_path = os.path.join(cur_dir, "../EthereumDataset", "AIC_node_type.txt")
     node_type_df = pd.read_csv(type_path, index_col='address')
 
-    address_list = [(i, n, n in phish_acc_list, generate_pair_idx(deanon_pair_list, n), node_type_df.loc[n]['type']) for i, n in enumerate(nodes)]  # TODO: optimize
-    address_df = pd.DataFrame.from_records(address_list, columns=['id', 'address', 'phish_flag', 'pair_idx', 'node_type'], index='id')
+    return phish_acc_list, deanon_pair_list, node_type_df
+
+
+def label_addresses(nodes, start_id=0):
+    phish_acc_list, deanon_pair_list, node_type_df = load_labels()
+
+    nodes = pd.Series(nodes, dtype=object)
+    pair_idx = nodes.map(generate_pair_idx(deanon_pair_list)).fillna(-1).astype(int)
+    node_type = node_type_df.loc[~node_type_df.index.duplicated(), 'type']
+    node_type = nodes.to_frame('address').merge(node_type, how='left', left_on='address', right_index=True)['type']
+
+    address_df = pd.DataFrame({'id': np.arange(start_id, start_id + len(nodes)),
+                               'address': nodes.values,
+                               'phish_flag': nodes.isin(set(phish_acc_list)).values,
+                               'pair_idx': pair_idx.values,
+                               'node_type': node_type.fillna(-1).astype(int).values}).set_index('id')
 
     return address_df
 
 
-def create_edges(address_df, start_date, end_date):
+def update_addresses(address_df, addresses):
+    """
+    Appends rows for the addresses that are not in address_df yet. Existing ids are kept and
+    the new ones continue after the largest id, in sorted address order.
+    """
+    new_nodes = np.unique(np.asarray(addresses, dtype=str))
+    new_nodes = new_nodes[~np.isin(new_nodes, address_df['address'].values.astype(str))].tolist()
+    if not new_nodes:
+        return address_df
+    start_id = int(address_df.index.max()) + 1 if len(address_df) else 0
+    return pd.concat([address_df, label_addresses(new_nodes, start_id=start_id)])
+
+
+def address_digest(address_df):
+    # identifies an address table by its ids and addresses
+    h = hashlib.md5(address_df.index.values.astype(np.int64).tobytes())
+    h.update(pd.util.hash_pandas_object(address_df['address'], index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def create_edges(address_df, start_date, end_date, freq='M'):
+    if partitions_current(address_df, freq):
+        return edges_for_window(address_df, start_date, end_date, freq)
+
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
 
-    data_path = os.path.join(cur_dir, "data", "eth_data.csv")
-    data_df = pd.read_csv(data_path, parse_dates=["block_timestamp"], index_col=0,
-                          usecols=['Unnamed: 0', 'hash', 'from_address', 'to_address', 'value', 'block_timestamp'])
-
     # clip dates
-    data_df = data_df.loc[(data_df["block_timestamp"] >= start_date) & (data_df["block_timestamp"] < end_date)]
+    data_df = load_transactions(['from_address', 'to_address', 'value', 'block_timestamp'], decode_addresses=False,
+                                start_date=start_date, end_date=end_date)
 
     print("Creating Graph")
-    edges = pd.merge(data_df.groupby(['from_address', 'to_address'])['value'].sum(),
-                     data_df.groupby(['from_address', 'to_address']).size().to_frame('count'),
+    return aggregate_edges(data_df, address_df, address_code_ids(address_df))
+
+
+def address_code_ids(address_df):
+    # store address code -> address id, None if the transactions are not dictionary-encoded
+    if not store_exists():
+        return None
+    positions = pd.Index(address_df['address']).get_indexer(load_dictionary().astype(str))
+    return np.where(positions >= 0, address_df.index.values[positions], -1)
+
+
+def aggregate_edges(data_df, address_df, code2id=None, keys=()):
+    keys = list(keys) + ['from_address', 'to_address']
+    edges = pd.merge(data_df.groupby(keys)['value'].sum(),
+                     data_df.groupby(keys).size().to_frame('count'),
                      left_index=True, right_index=True).reset_index()
 
-    address_df_ = address_df.set_index('address')
-    address_df_['id'] = address_df.index
-    edges['from_address'] = edges['from_address'].map(address_df_['id'].to_dict())
-    edges['to_address'] = edges['to_address'].map(address_df_['id'].to_dict())
+    if code2id is not None:  # addresses are store codes
+        edges['from_address'] = code2id[edges['from_address'].values]
+        edges['to_address'] = code2id[edges['to_address'].values]
+    else:
+        address_df_ = address_df.set_index('address')
+        address_df_['id'] = address_df.index
+        edges['from_address'] = edges['from_address'].map(address_df_['id'].to_dict())
+        edges['to_address'] = edges['to_address'].map(address_df_['id'].to_dict())
 
-    for col in edges.columns:
-        if col != 'value':
-            edges[col] = edges[col].astype(int)
+    for col in ['from_address', 'to_address', 'count']:
+        edges[col] = edges[col].astype(int)
     # edges.sort_values(by='id', inplace=True)
 
     return edges
 
 
-def generate_pair_idx(deanon_pair_list, address):
-    deanon_pair_list_flat = [item for pair in deanon_pair_list for item in pair]
-    try:
-        idx = deanon_pair_list_flat.index(address) // 2
-    except:
-        idx = -1
-    return idx
+def update_edges(edges, new_edges):
+    """
+    Merges aggregated edges of a new batch into existing ones: sums and counts are added for
+    (from, to) pairs seen before and unseen pairs are appended at the end.
+    """
+    keys = ['from_address', 'to_address']
+    merged = edges[keys + ['value', 'count']].set_index(keys)
+    new_edges = new_edges.groupby(keys)[['value', 'count']].sum()
+
+    seen = new_edges.index.isin(merged.index)
+    common = new_edges.index[seen]
+    merged.loc[common, 'value'] += new_edges.loc[common, 'value']
+    merged.loc[common, 'count'] += new_edges.loc[common, 'count']
+    merged = pd.concat([merged, new_edges.loc[~seen]]).reset_index()
+    merged['count'] = merged['count'].astype(int)
+    return merged
+
+
+def edge_partition_path(freq='M'):
+    return os.path.join(cur_dir, "data", f"edge_parts_{freq}")
+
+
+def partition_meta(address_df):
+    return {'data_version': data_version(), 'address_digest': address_digest(address_df)}
+
+
+def save_partition_meta(address_df, freq='M'):
+    with open(os.path.join(edge_partition_path(freq), "meta.json"), "w") as f:
+        json.dump(partition_meta(address_df), f, indent=2)
+
+
+def partitions_current(address_df, freq='M'):
+    # partitions built from another store or address table hold other transactions or ids
+    meta_path = os.path.join(edge_partition_path(freq), "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, "r") as f:
+        return json.load(f) == partition_meta(address_df)
+
+
+def save_edge_partition(edges, path, bucket):
+    np.savez(os.path.join(path, f"{bucket}.npz"), **{col: edges[col].values for col in edge_columns})
+
+
+def load_edge_partition(path, bucket):
+    with np.load(os.path.join(path, f"{bucket}.npz")) as f:
+        return pd.DataFrame({col: f[col] for col in edge_columns})
+
+
+def create_edge_partitions(address_df, freq='M'):
+    """
+    Precomputes the value sum and count per (from, to) for every time bucket, so that edges of
+    any date window can be merged from the partitions (see edges_for_window).
+
+    :param freq: bucket size as a numpy datetime unit, 'Y', 'M' or 'D'
+    """
+    assert freq in ['Y', 'M', 'D'], 'Invalid bucket size'
+    data_df = load_transactions(['from_address', 'to_address', 'value', 'block_timestamp'], decode_addresses=False)
+    data_df['bucket'] = data_df['block_timestamp'].values.astype(f"datetime64[{freq}]")
+    edges = aggregate_edges(data_df, address_df, address_code_ids(address_df), keys=['bucket'])
+
+    path = edge_partition_path(freq)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    for bucket, bucket_edges in tqdm(edges.groupby('bucket')):
+        save_edge_partition(bucket_edges, path, np.datetime64(bucket, freq))
+    # written last, partitions without it are never used
+    save_partition_meta(address_df, freq)
+
+
+def update_edge_partitions(batch_df, address_df, freq='M'):
+    # merges a batch of transactions with address strings into the partitions it touches
+    path = edge_partition_path(freq)
+    batch_df = batch_df.assign(bucket=batch_df['block_timestamp'].values.astype(f"datetime64[{freq}]"))
+    edges = aggregate_edges(batch_df, address_df, keys=['bucket'])
+    for bucket, new_edges in edges.groupby('bucket'):
+        bucket = np.datetime64(bucket, freq)
+        if os.path.isfile(os.path.join(path, f"{bucket}.npz")):
+            new_edges = update_edges(load_edge_partition(path, bucket), new_edges)
+        save_edge_partition(new_edges, path, bucket)
+
+
+def edges_for_window(address_df, start_date, end_date, freq='M'):
+    """
+    Returns the same edges as create_edges for [start_date, end_date), merging the partitions that
+    lie inside the window and aggregating the transactions of the partially covered buckets at its ends.
+    """
+    path = edge_partition_path(freq)
+    start_date = pd.to_datetime(start_date).to_datetime64()
+    end_date = pd.to_datetime(end_date).to_datetime64()
+
+    # first bucket starting at or after start_date, last bucket ending at or before end_date
+    first_bucket = start_date.astype(f"datetime64[{freq}]")
+    if first_bucket < start_date:
+        first_bucket += 1
+    end_bucket = end_date.astype(f"datetime64[{freq}]")
+
+    edges_list = []
+    if first_bucket < end_bucket:
+        ranges = [(start_date, first_bucket), (end_bucket, end_date)]
+        for name in sorted(n for n in os.listdir(path) if n.endswith(".npz")):
+            bucket = np.datetime64(name[:-len(".npz")], freq)
+            if first_bucket <= bucket < end_bucket:
+                edges_list.append(load_edge_partition(path, bucket))
+    else:
+        ranges = [(start_date, end_date)]
+
+    code2id = address_code_ids(address_df)
+    for range_start, range_end in ranges:
+        if range_start < range_end:
+            data_df = load_transactions(['from_address', 'to_address', 'value'], decode_addresses=False,
+                                        start_date=range_start, end_date=range_end)
+            edges_list.append(aggregate_edges(data_df, address_df, code2id))
+
+    if not edges_list:
+        return pd.DataFrame({col: pd.Series(dtype=float if col == 'value' else int) for col in edge_columns})
+    edges = pd.concat(edges_list, ignore_index=True)
+    edges = edges.groupby(['from_address', 'to_address'], as_index=False)[['value', 'count']].sum()
+    edges['count'] = edges['count'].astype(int)
+    return edges
+
+
+def generate_pair_idx(deanon_pair_list):
+    # address -> index of the first pair it appears in
+    pair_idx = {}
+    for idx, pair in enumerate(deanon_pair_list):
+        for address in pair:
+            pair_idx.setdefault(address, idx)
+    return pair_idx
 
 
 if __name__ == '__main__':
@@ -94,12 +276,21 @@ if __name__ == '__main__':
         address_df = create_addresses()
         address_df.to_csv(address_data_path)
 
+    adj_path = adjacency_path(start_date, end_date)
     if os.path.isfile(edges_data_path):
         print('Loading edges...')
         edges = pd.read_csv(edges_data_path)
+        # an existing index also holds the batches update_data.py merged into it after the csv was written
+        build_index = not adjacency_exists(adj_path)
     else:
         print('Creating edges...')
+        if not partitions_current(address_df):
+            print('Creating edge partitions...')
+            create_edge_partitions(address_df)
         edges = create_edges(address_df, start_date=start_date, end_date=end_date)
         edges.to_csv(edges_data_path)
+        build_index = True
 
-
+    if build_index:
+        print('Creating adjacency index...')
+        save_adjacency(build_adjacency(edges, num_nodes=int(address_df.index.max()) + 1), adj_path)
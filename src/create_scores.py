@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from model_helper import load_embedding, load_classifier
+from create_graph import address_digest
+
+
+cur_dir = os.path.dirname(__file__)
+# phishing probability per address id (row of address_data.csv), nan for addresses without an embedding
+score_table_path = os.path.join(cur_dir, "data", "phish_scores.npy")
+# the address table the scores were computed for, as ids change when it is rebuilt
+score_meta_path = os.path.join(cur_dir, "data", "phish_scores.json")
+
+
+def score_rows(row_range):
+    start, stop = row_range
+    X, _ = load_embedding()
+    return start, load_classifier().predict_proba(np.asarray(X[start:stop]))[:, 1]
+
+
+def load_score_table(path=score_table_path):
+    return np.load(path, mmap_mode="r")
+
+
+def score_table_meta(address_df):
+    return {"num_addresses": len(address_df), "address_digest": address_digest(address_df)}
+
+
+def score_table_current(address_df):
+    if not os.path.isfile(score_table_path) or not os.path.isfile(score_meta_path):
+        return False
+    with open(score_meta_path, "r") as f:
+        return json.load(f) == score_table_meta(address_df)
+
+
+def run(chunksize=100_000, n_jobs=1):
+    """
+    Scores every embedding row with data/classifier.pkl in chunks of chunksize rows and writes
+    the scores indexed by address id to data/phish_scores.npy.
+    """
+    address_df = pd.read_csv(os.path.join(cur_dir, "data", "address_data.csv"), index_col='id')
+    X, address_list = load_embedding()
+    load_classifier()  # loaded before forking, so the workers share it where fork is available
+
+    start_time = time.time()
+    row_scores = np.empty(X.shape[0], dtype=np.float32)
+    row_ranges = [(start, min(start + chunksize, X.shape[0])) for start in range(0, X.shape[0], chunksize)]
+    if n_jobs > 1:
+        ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        with ctx.Pool(n_jobs) as pool:
+            results = pool.imap_unordered(score_rows, row_ranges)
+            for start, scores in tqdm(results, total=len(row_ranges), desc="Scoring"):
+                row_scores[start:start + len(scores)] = scores
+    else:
+        for start, scores in tqdm(map(score_rows, row_ranges), total=len(row_ranges), desc="Scoring"):
+            row_scores[start:start + len(scores)] = scores
+
+    ids = pd.Index(address_df['address']).get_indexer(np.asarray(address_list).astype(str))
+    found = ids >= 0
+    table = np.full(int(address_df.index.max()) + 1, np.nan, dtype=np.float32)
+    table[address_df.index.values[ids[found]]] = row_scores[found]
+
+    # the table only counts as current once its meta is written
+    if os.path.isfile(score_meta_path):
+        os.remove(score_meta_path)
+    tmp_path = score_table_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, table)
+    os.replace(tmp_path, score_table_path)
+    with open(score_meta_path, "w") as f:
+        json.dump(score_table_meta(address_df), f, indent=2)
+    print(f"Scored {X.shape[0]} rows in {time.time() - start_time:.1f}s, "
+          f"{found.sum()} of {len(address_df)} addresses have a score")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score all embeddings with the phishing classifier")
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    args = parser.parse_args()
+    run(chunksize=args.chunksize, n_jobs=args.n_jobs)
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 import pickle as pkl
@@ -5,6 +6,18 @@ from tqdm import tqdm
 from numpy import dot
 from numpy.linalg import norm
 
+from ann_index import (ivf_index_path, quantized_path, embedding_stamp, load_index, search_ivf, search_quantized,
+                       squared_distances)
+
+
+cur_dir = os.path.dirname(__file__)
+embedding_file = os.path.join(cur_dir, "data", "ts_embedding_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy")
+address_file = os.path.join(cur_dir, "data", "ts_address_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy")
+classifier_file = os.path.join(cur_dir, "data", "classifier.pkl")
+
+# resident per process: the arrays are memory-mapped, so workers share the pages through the OS cache
+embedding_store = {}
+
 
 def euclidean_dist(a, b):
     return np.sqrt(np.sum(np.square(a - b)))
@@ -53,32 +66,146 @@ def get_neighbors(X, idx, metric="cosine", include_idx_mask=[]):
     return indices, distances
 
 
-def query_topk(query_address, top_k):
-    embedding_input_file = "./data/ts_embedding_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy"
-    X = np.load(embedding_input_file)
-
-    address_input_file = "./data/ts_address_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy"
-    address_list = np.load(address_input_file)
-
-    # map address to int
-    cnt = 0
-    address_to_idx = {}
-    idx_to_address = {}
-    for address in address_list:
-        address_to_idx[address] = cnt
-        idx_to_address[cnt] = address
-        cnt += 1
+def query_topk(query_address, top_k, n_probe=None, quantized=None):
+    """
+    :param n_probe: None for exact search, otherwise the number of IVF lists searched (see ann_index)
+    :param quantized: None, "int8" or "float16" to search the quantized embeddings and re-rank the
+                      candidates with the original vectors
+    """
+    X, address_list = load_embedding()
+    address_to_idx = load_address_index()
 
     query_idx = address_to_idx[query_address]
 
-    indices, distances = get_neighbors(X, query_idx, "euclidean")
-    top_address_list = list(map(lambda x: idx_to_address[x], indices[:top_k]))
+    if quantized is not None:
+        indices, distances = search_quantized(load_quantized(quantized), X, X[query_idx], top_k, exclude_idx=query_idx)
+    elif n_probe is None:
+        indices, distances = get_neighbors(X, query_idx, "euclidean")
+    else:
+        indices, distances = search_ivf(load_ann_index(), X, X[query_idx], top_k, n_probe=n_probe, exclude_idx=query_idx)
+    top_address_list = [address_list[i] for i in indices[:top_k]]
     top_distance_list = distances[:top_k]
 
     return top_address_list, top_distance_list
 
 
+def query_topk_batch(query_addresses, top_k, block_size=4096):
+    """
+    Exact euclidean top-k for many addresses. Queries and embeddings are both processed in blocks
+    of block_size rows, keeping a running top-k per query, so peak memory is about block_size^2 floats.
+
+    :return: generator of (query_address, top_address_list, top_distance_list), with empty lists for
+             addresses that have no embedding
+    """
+    X, address_list = load_embedding()
+    address_to_idx = load_address_index()
+    num_rows = X.shape[0]
+    k = min(top_k, num_rows - 1)
+
+    X_sq_norms = np.empty(num_rows, dtype=np.float32)
+    for start in range(0, num_rows, block_size):
+        block = np.asarray(X[start:start + block_size], dtype=np.float32)
+        X_sq_norms[start:start + block_size] = np.einsum("ij,ij->i", block, block)
+
+    for q_start in range(0, len(query_addresses), block_size):
+        q_addresses = query_addresses[q_start:q_start + block_size]
+        q_idx = np.array([address_to_idx.get(a, -1) for a in q_addresses])
+        known = q_idx >= 0
+        Q = np.asarray(X[q_idx[known]], dtype=np.float32)
+
+        best_dist = np.full((len(Q), k), np.inf, dtype=np.float32)
+        best_idx = np.full((len(Q), k), -1, dtype=np.int64)
+        for start in range(0, num_rows if len(Q) else 0, block_size):
+            block = np.asarray(X[start:start + block_size], dtype=np.float32)
+            dist = squared_distances(Q, block, X_sq_norms[start:start + block_size])
+            block_idx = np.arange(start, start + len(block))
+            dist[block_idx[None, :] == q_idx[known][:, None]] = np.inf  # exclude self distance
+
+            cand_dist = np.concatenate([best_dist, dist], axis=1)
+            cand_idx = np.concatenate([best_idx, np.broadcast_to(block_idx, dist.shape)], axis=1)
+            keep = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+            best_dist = np.take_along_axis(cand_dist, keep, axis=1)
+            best_idx = np.take_along_axis(cand_idx, keep, axis=1)
+
+        order = np.argsort(best_dist, axis=1, kind="stable")
+        best_dist = np.sqrt(np.take_along_axis(best_dist, order, axis=1))
+        best_idx = np.take_along_axis(best_idx, order, axis=1)
+
+        row = 0
+        for address, is_known in zip(q_addresses, known):
+            if is_known:
+                yield address, [address_list[i] for i in best_idx[row]], best_dist[row].tolist()
+                row += 1
+            else:
+                yield address, [], []
+
+
 def load_embedding():
-    embeddings = np.load("./data/ts_embedding_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy")
-    address_for_embedding = np.load("./data/ts_address_bert4eth_1M_min3_dup_seq100_mask80_shared_zipfan1000_72000.npy")
-    return embeddings, address_for_embedding
+    if "embeddings" not in embedding_store:
+        embedding_store["embeddings"] = np.load(embedding_file, mmap_mode="r")
+        embedding_store["addresses"] = np.load(address_file, mmap_mode="r")
+    return embedding_store["embeddings"], embedding_store["addresses"]
+
+
+def load_address_index():
+    # address -> embedding row
+    if "address_to_idx" not in embedding_store:
+        _, address_list = load_embedding()
+        embedding_store["address_to_idx"] = {address: idx for idx, address in enumerate(address_list.tolist())}
+    return embedding_store["address_to_idx"]
+
+
+def load_current_index(path):
+    # an index of older embeddings would point at the wrong rows
+    X, _ = load_embedding()
+    index = load_index(path, embedding_stamp(embedding_file, X.shape[0]))
+    if index is None:
+        raise RuntimeError(f"{path} was built from other embeddings, rebuild it with ann_index.py.")
+    return index
+
+
+def load_ann_index():
+    if "ivf_index" not in embedding_store:
+        embedding_store["ivf_index"] = load_current_index(ivf_index_path(embedding_file))
+    return embedding_store["ivf_index"]
+
+
+def load_quantized(kind="int8"):
+    if kind not in embedding_store:
+        embedding_store[kind] = load_current_index(quantized_path(embedding_file, kind))
+    return embedding_store[kind]
+
+
+def load_classifier():
+    # unpickled once per process and warmed up with one prediction, so the first request is not slower
+    if "classifier" not in embedding_store:
+        with open(classifier_file, "rb") as f:
+            classifier = pkl.load(f)
+        X, _ = load_embedding()
+        classifier.predict_proba(np.asarray(X[:1]))
+        embedding_store["classifier"] = classifier
+    return embedding_store["classifier"]
+
+
+def score_addresses(addresses):
+    """
+    Phishing scores of many addresses with one predict_proba call.
+
+    :return: float array aligned with addresses, nan for addresses without an embedding
+    """
+    address_to_idx = load_address_index()
+    idx = np.array([address_to_idx.get(address, -1) for address in addresses], dtype=np.int64)
+    known = idx >= 0
+    scores = np.full(len(idx), np.nan)
+    if known.any():
+        X, _ = load_embedding()
+        scores[known] = load_classifier().predict_proba(np.asarray(X[idx[known]]))[:, 1]
+    return scores
+
+
+def score_address(address):
+    """
+    :return: phishing score of address, None if it has no embedding
+    """
+    score = score_addresses([address])[0]
+    return None if np.isnan(score) else float(score)
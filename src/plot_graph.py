@@ -1,18 +1,27 @@
 import os
+import json
 import random
 import shutil
+import hashlib
+import multiprocessing as mp
 
 import matplotlib
 import networkx as nx
 import numpy as np
 import pandas as pd
+import pyvis
 from pyvis.network import Network
 from tqdm import tqdm
 
 from create_graph import *
+from adjacency import (build_adjacency, save_adjacency, load_adjacency, adjacency_exists, adjacency_path, ego_edges,
+                       edges_frame)
+from create_scores import score_table_path, load_score_table, score_table_current
+from artifacts import compress_artifact, compress_tree, write_artifact
 
 
-def plot_graph(edges, address_list, task='deanon', mode='label', combine_addresses_flag=False, folder=''):
+def plot_graph(edges, address_list, task='deanon', mode='label', combine_addresses_flag=False, folder='', n_jobs=1,
+               output_format='html'):
     '''
 
     :param edges:
@@ -20,10 +29,14 @@ def plot_graph(edges, address_list, task='deanon', mode='label', combine_address
     :param task:
     :param mode:
     :param combine_addresses_flag:
+    :param n_jobs: number of rendering processes, the order of the returned paths does not depend on it
+    :param output_format: 'html' for standalone pyvis pages, 'json' for graph data files shown by
+                          assets/graph_viewer.html
     :return:
     '''
 
     assert task in ['deanon', 'phish'], 'Invalid task'
+    assert output_format in ['html', 'json'], 'Invalid output format'
     if task == 'deanon':
         if combine_addresses_flag:
             print('Switching to combine_addresses_flag=False because the task is deanonymization')
@@ -37,24 +50,11 @@ def plot_graph(edges, address_list, task='deanon', mode='label', combine_address
 
     address_data_path = os.path.join("data", "address_data.csv")
     address_df = pd.read_csv(address_data_path, index_col='id')
-    address_df_ = address_df.set_index('address')
-    address_df_['id'] = address_df.index
 
-    preds = None
-    if mode == 'pred' or mode == 'label-pred':
-        if task == 'deanon':
-            preds = pd.read_csv(os.path.join('../EthereumDataset', 'AIC_ENS_pred_similarity_proba_PSBERT.txt'), sep=',')
-            preds['query_addr'] = preds['query_addr'].map(address_df_['id'].to_dict(), na_action='ignore')
-            preds['cand_addr'] = preds['cand_addr'].map(address_df_['id'].to_dict()).astype(int)
-            preds.dropna(inplace=True)
-            preds['query_addr'] = preds['query_addr'].astype(int)
-            preds.set_index(['query_addr', 'cand_addr'], inplace=True)
-        else:
-            preds = pd.read_csv(os.path.join('../EthereumDataset', 'AIC_eoa_pred_phishing_proba_BERT4ETH.txt'), sep=',')
-            preds['address'] = preds['address'].map(address_df_['id'].to_dict(), na_action='ignore')
-            preds.dropna(inplace=True)
-            preds['address'] = preds['address'].astype(int)
-            preds.set_index('address', inplace=True)
+    if isinstance(edges, pd.DataFrame):
+        edges = build_adjacency(edges, num_nodes=int(address_df.index.max()) + 1)
+
+    preds = load_preds(task, mode, address_df)
 
     html_path_list = []
 
@@ -66,29 +66,146 @@ def plot_graph(edges, address_list, task='deanon', mode='label', combine_address
             print(combined_ego_graph)
         graph = combined_ego_graph
         tag = f"{task}_{mode}_{'_'.join(address_list)}"
-        html_path = plot_graph_helper(graph, address_df, task, mode, address_list, preds, tag, folder)
+        write_graph = plot_graph_helper if output_format == 'html' else write_graph_json
+        html_path = write_graph(graph, address_df, task, mode, address_list, preds, tag, folder)
         html_path_list.append(html_path)
     else:
         if task == 'phish' or mode == 'pred':
-            for address in tqdm(address_list):
-                tag = f"{task}_{mode}_{address}"
-                ego_graph = get_subgraph(edges, address)
-                html_path = plot_graph_helper(ego_graph, address_df, task, mode, [address], preds, tag, folder)
-                html_path_list.append(html_path)
+            render_tasks = [(f"{task}_{mode}_{address}", [address]) for address in address_list]
         else:  # deanon label or deanon label-pred
-            for pair in tqdm(address_list):
-                combined_ego_graph = nx.DiGraph()
-                for address in pair:
-                    ego_graph = get_subgraph(edges, address)
-                    combined_ego_graph = nx.compose(ego_graph, combined_ego_graph)
-                tag = f"{task}_{mode}_{pair[0]}_{pair[1]}"
-                html_path = plot_graph_helper(combined_ego_graph, address_df, task, mode, pair, preds, tag, folder)
-                html_path_list.append(html_path)
+            render_tasks = [(f"{task}_{mode}_{pair[0]}_{pair[1]}", pair) for pair in address_list]
+
+        cache = load_render_cache(folder)
+        worker_args = (edges, address_df, task, mode, preds, folder, cache, output_format)
+        if n_jobs == 1:
+            init_render_worker(*worker_args)
+            results = [render_task(render_args) for render_args in tqdm(render_tasks)]
+        else:
+            # with fork the workers share the tables copy-on-write, otherwise they get one copy each at start
+            ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+            with ctx.Pool(n_jobs, initializer=init_render_worker, initargs=worker_args) as pool:
+                chunksize = max(1, min(16, len(render_tasks) // (4 * n_jobs)))
+                results = list(tqdm(pool.imap(render_task, render_tasks, chunksize=chunksize),
+                                    total=len(render_tasks)))
+
+        html_path_list = [html_path for html_path, _, _ in results]
+        for (tag, _), (_, digest, _) in zip(render_tasks, results):
+            cache[tag] = digest
+        save_render_cache(folder, cache)
+        print(f'{sum(rendered for _, _, rendered in results)} rendered, '
+              f'{sum(not rendered for _, _, rendered in results)} unchanged')
 
     return html_path_list
 
 
-def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, tag='', folder=''):
+def load_preds(task, mode, address_df):
+    if mode != 'pred' and mode != 'label-pred':
+        return None
+
+    address_df_ = address_df.set_index('address')
+    address_df_['id'] = address_df.index
+    if task == 'deanon':
+        preds = pd.read_csv(os.path.join(cur_dir, '../EthereumDataset', 'AIC_ENS_pred_similarity_proba_PSBERT.txt'), sep=',')
+        preds['query_addr'] = preds['query_addr'].map(address_df_['id'].to_dict(), na_action='ignore')
+        preds['cand_addr'] = preds['cand_addr'].map(address_df_['id'].to_dict()).astype(int)
+        preds.dropna(inplace=True)
+        preds['query_addr'] = preds['query_addr'].astype(int)
+        preds.set_index(['query_addr', 'cand_addr'], inplace=True)
+    elif score_table_current(address_df):
+        # array indexed by address id, written by create_scores.py
+        preds = load_score_table()
+    else:
+        if os.path.isfile(score_table_path):
+            print(f"{score_table_path} was computed for another address table, using the BERT4ETH predictions")
+        preds = pd.read_csv(os.path.join(cur_dir, '../EthereumDataset', 'AIC_eoa_pred_phishing_proba_BERT4ETH.txt'), sep=',')
+        preds['address'] = preds['address'].map(address_df_['id'].to_dict(), na_action='ignore')
+        preds.dropna(inplace=True)
+        preds['address'] = preds['address'].astype(int)
+        preds.set_index('address', inplace=True)
+    return preds
+
+
+render_state = {}
+
+
+def init_render_worker(edges, address_df, task, mode, preds, folder, cache, output_format='html'):
+    render_state.update(edges=edges, address_df=address_df, task=task, mode=mode, preds=preds, folder=folder,
+                        cache=cache, output_format=output_format, options=read_graph_options())
+
+
+def render_task(render_args):
+    # returns the output path, the digest of its inputs and whether it had to be rendered
+    tag, address_list = render_args
+    edges = render_state['edges']
+    if len(address_list) == 1:
+        graph = get_subgraph(edges, address_list[0])
+    else:
+        graph = nx.DiGraph()
+        for address in address_list:
+            ego_graph = get_subgraph(edges, address)
+            graph = nx.compose(ego_graph, graph)
+
+    address_df, task, mode, preds, folder = [render_state[k] for k in ['address_df', 'task', 'mode', 'preds', 'folder']]
+    output_format = render_state['output_format']
+    out_path = os.path.join(folder, f'{tag}.{output_format}') if folder else f'{tag}.{output_format}'
+    digest = graph_digest(graph, address_df, task, mode, address_list, preds, render_state['options'])
+    if render_state['cache'].get(tag) == digest and os.path.isfile(out_path):
+        return out_path, digest, False
+    write_graph = plot_graph_helper if output_format == 'html' else write_graph_json
+    return write_graph(graph, address_df, task, mode, address_list, preds, tag, folder), digest, True
+
+
+def graph_digest(graph, address_df, task, mode, address_list, preds, options):
+    """
+    Hash of everything a rendered graph depends on: the edges and their widths, the address rows and
+    prediction values of its nodes, and the graph options.
+    """
+    nodes = list(graph.nodes)
+    rows = address_df.loc[nodes, ['address', 'phish_flag', 'pair_idx', 'node_type']].values.tolist()
+    content = {
+        'task': task,
+        'mode': mode,
+        'address_list': [int(a) for a in address_list],
+        'edges': [[int(u), int(v), int(w)] for u, v, w in graph.edges(data='width')],
+        'nodes': [[int(i)] + row for i, row in zip(nodes, rows)],
+        'preds': [get_pred_value(preds, task, address_list, i) for i in nodes] if preds is not None else [],
+        'options': options,
+    }
+    return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+
+def load_render_cache(folder):
+    cache_path = os.path.join(folder, '.render_cache.json')
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, 'r') as f:
+        return json.load(f)
+
+
+def save_render_cache(folder, cache):
+    with open(os.path.join(folder, '.render_cache.json'), 'w') as f:
+        json.dump(cache, f)
+
+
+def get_pred_value(preds, task, address_list, node):
+    if task == 'phish' and isinstance(preds, np.ndarray):
+        val = float(preds[node]) if node < len(preds) else 0.
+        val = 0. if np.isnan(val) else val
+    elif task == 'phish':
+        try:
+            val = float(preds.loc[node].pred_phishing_proba)
+        except:
+            val = 0.
+
+    else:
+        try:
+            val = float(preds.loc[address_list[0], node].pred_score)
+        except:
+            val = 0.
+    return val
+
+
+def decorate_graph(graph, address_df, task, mode, address_list, preds=None):
     # hover titles
     labels = dict([(i, address_df.loc[i]['address']) for i in graph.nodes])
     nx.set_node_attributes(graph, labels, 'title')
@@ -114,18 +231,7 @@ def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, t
 
             labels = {}
             for i in graph.nodes:
-                if task == 'phish':
-                    try:
-                        val = float(preds.loc[i].pred_phishing_proba)
-                    except:
-                        val = 0.
-
-                else:
-                    try:
-                        val = float(preds.loc[address_list[0], i].pred_score)
-                    except:
-                        val = 0.
-
+                val = get_pred_value(preds, task, address_list, i)
                 if val > 0.1:
                     labels[i] = f'{val:.3f}'
             nx.set_node_attributes(graph, labels, 'label')
@@ -133,20 +239,11 @@ def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, t
     else:
         colors = {}
         for i in graph.nodes:
+            val = get_pred_value(preds, task, address_list, i)
             if task == 'phish':
-                try:
-                    val = float(preds.loc[i].pred_phishing_proba)
-                except:
-                    val = 0.
-
                 colors[i] = matplotlib.colors.to_hex(matplotlib.colormaps['Reds'](val))
 
             else:
-                try:
-                    val = float(preds.loc[address_list[0], i].pred_score)
-                except:
-                    val = 0.
-
                 colors[i] = matplotlib.colors.to_hex(matplotlib.colormaps['Reds'](val ** 5))
 
     nx.set_node_attributes(graph, colors, 'color')
@@ -159,6 +256,10 @@ def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, t
             shapes[i] = 'dot'
     nx.set_node_attributes(graph, shapes, 'shape')
 
+
+def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, tag='', folder=''):
+    decorate_graph(graph, address_df, task, mode, address_list, preds)
+
     # colors
     nt = Network(height="1000px", width="1000px", select_menu=True, directed=True)
     nt.from_nx(graph)
@@ -176,11 +277,57 @@ def plot_graph_helper(graph, address_df, task, mode, address_list, preds=None, t
     else:
         html_path = f'{tag}.html'
 
-    nt.write_html(html_path, local=True)
+    # same file as nt.write_html(html_path, local=True), which also re-copies ./lib on every call
+    # and is therefore not safe with several rendering processes
+    write_artifact(html_path, nt.generate_html(html_path, local=True))
+    compress_artifact(html_path)
     # time.sleep(20)
     return html_path
 
 
+def graph_json(graph, options):
+    """
+    Compact form of a decorated graph: node attributes as arrays aligned with id, colors and shapes as
+    indices into small palettes, and edges as positions in id.
+    """
+    nodes = list(graph.nodes)
+    position = {node: i for i, node in enumerate(nodes)}
+    colors, shapes = [], []
+    color_idx, shape_idx = [], []
+    for node in nodes:
+        for value, palette, idx in [(graph.nodes[node].get('color', '#97c2fc'), colors, color_idx),
+                                    (graph.nodes[node].get('shape', 'dot'), shapes, shape_idx)]:
+            if value not in palette:
+                palette.append(value)
+            idx.append(palette.index(value))
+    edges = list(graph.edges(data='width', default=1))
+    return {
+        'id': [int(node) for node in nodes],
+        'label': [graph.nodes[node].get('label') for node in nodes],  # null for the default label, the id
+        'title': [graph.nodes[node].get('title') for node in nodes],
+        'color': color_idx,
+        'colors': colors,
+        'shape': shape_idx,
+        'shapes': shapes,
+        'from': [position[u] for u, _, _ in edges],
+        'to': [position[v] for _, v, _ in edges],
+        'width': [int(w) for _, _, w in edges],
+        'options': options,
+    }
+
+
+def write_graph_json(graph, address_df, task, mode, address_list, preds=None, tag='', folder=''):
+    # the data of one graph for the shared assets/graph_viewer.html page, gzipped next to it
+    decorate_graph(graph, address_df, task, mode, address_list, preds)
+    options = read_graph_options()
+    content = graph_json(graph, json.loads(options[options.index('{'):options.rindex('}') + 1]))
+
+    json_path = os.path.join(folder, f'{tag}.json') if folder else f'{tag}.json'
+    write_artifact(json_path, json.dumps(content, separators=(',', ':')))
+    compress_artifact(json_path)
+    return json_path
+
+
 def set_edge_width(edges):
     edges['value'] = (np.log10(edges.value).clip(0) + 1).astype(int)  # for width
     edges = list(edges[['from_address', 'to_address', 'value']].itertuples(index=False, name=None))
@@ -188,36 +335,34 @@ def set_edge_width(edges):
     return edges
 
 
-def get_subgraph(edges, node, n=2):
-    if n != 2:
-        raise NotImplementedError
-
-    edges_from = edges[edges.from_address == node]
-    edges_to = edges[edges.to_address == node]
-    edges_list = [edges_from, edges_to]
-    nodes_to = edges_from.to_address
-    nodes_from = edges_to.from_address
-    one_hops = list(set(nodes_to.to_list()))   # to
-    # one_hops = list(set(nodes_to.to_list() + nodes_from.to_list()))   # to + from
+def get_subgraph(edges, node, n=2, direction='out'):
+    '''
 
-    for _node in one_hops:
-        _to = edges[edges.from_address == _node]  # to
-        # _from = edges[edges.to_address == _node]  # from
-        edges_list.append(pd.concat([_to]))
+    :param edges: adjacency index (see adjacency.build_adjacency) or the create_edges DataFrame
+    :param node: address id of the root
+    :param n: number of hops
+    :param direction: 'out', 'in' or 'both', the edges followed after the root
+    :return: nx.DiGraph
+    '''
+    if isinstance(edges, pd.DataFrame):
+        edges = build_adjacency(edges)
 
-    edges_two_hop = pd.concat(edges_list)
-    edges_two_hop.drop_duplicates(inplace=True)
-    edges_two_hop = set_edge_width(edges_two_hop)
+    edges_n_hop = edges_frame(edges, ego_edges(edges, node, n=n, direction=direction))
+    edges_n_hop = set_edge_width(edges_n_hop)
 
     subgraph = nx.DiGraph()
-    subgraph.add_edges_from(edges_two_hop)
+    subgraph.add_edges_from(edges_n_hop)
     return subgraph
 
 
-def set_graph_options(nt):
-    options_text_path = os.path.join("data", "options.txt")
+def read_graph_options():
+    options_text_path = os.path.join(cur_dir, "data", "options.txt")
     with open(options_text_path, "r") as f:
-        nt.set_options(f.read())
+        return f.read()
+
+
+def set_graph_options(nt):
+    nt.set_options(read_graph_options())
 
 
 def get_colors(cmap='Dark2'):
@@ -249,13 +394,25 @@ if __name__ == '__main__':
         address_df = create_addresses()
         address_df.to_csv(address_data_path)
 
+    adj_path = adjacency_path(start_date, end_date)
     if os.path.isfile(edges_data_path):
         print('Loading edges...')
         edges = pd.read_csv(edges_data_path)
+        # an existing index also holds the batches update_data.py merged into it after the csv was written
+        build_index = not adjacency_exists(adj_path)
     else:
         print('Creating edges...')
         edges = create_edges(address_df, start_date=start_date, end_date=end_date)
         edges.to_csv(edges_data_path)
+        build_index = True
+
+    if build_index:
+        print('Creating adjacency index...')
+        adj = build_adjacency(edges, num_nodes=int(address_df.index.max()) + 1)
+        save_adjacency(adj, adj_path)
+    else:
+        print('Loading adjacency index...')
+        adj = load_adjacency(adj_path)
 
     if task == 'phish':
         address_list = list(address_df[address_df.phish_flag == True].index)
@@ -276,7 +433,13 @@ if __name__ == '__main__':
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-    html_path_list = plot_graph(edges, address_list=address_list, task=task, mode=mode, combine_addresses_flag=False, folder=folder)
-    shutil.copytree('lib', os.path.join(folder, 'lib'))
+    output_format = 'json'  # json: data files for assets/graph_viewer.html, html: standalone pyvis pages
+    html_path_list = plot_graph(adj, address_list=address_list, task=task, mode=mode, combine_addresses_flag=False, folder=folder,
+                                n_jobs=os.cpu_count(), output_format=output_format)
+    if output_format == 'html':
+        shutil.copytree(os.path.join(os.path.dirname(pyvis.__file__), 'templates', 'lib'), os.path.join(folder, 'lib'),
+                        dirs_exist_ok=True)
+        # precompressed copies for the app's /outputs route
+        compress_tree(folder)
 
     print(html_path_list)
@@ -0,0 +1,53 @@
+import gc
+import os
+import argparse
+
+
+def load_server(lazy=False):
+    """
+    Imports the app and returns its Flask server.
+
+    By default the data, indexes, graphs and classifier are loaded here, once in the master process
+    before the workers fork. With lazy, every worker answers right away and loads them on a
+    background thread (see /ready).
+    """
+    import app
+    if lazy:
+        app.start_loading()
+        return app.app.server
+    app.load_state()
+    # objects created so far are moved out of the garbage collector's reach, so the workers'
+    # collections do not write to (and copy) the shared pages
+    gc.freeze()
+    return app.app.server
+
+
+def run(bind="127.0.0.1:8050", workers=None, threads=4, timeout=120, lazy=False):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError("gunicorn is required for serving, install it with `pip install gunicorn`.")
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in {"bind": bind, "workers": workers or os.cpu_count(), "threads": threads,
+                               "timeout": timeout, "preload_app": not lazy}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_server(lazy)
+
+    Application().run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the dashboard from several worker processes")
+    parser.add_argument("--bind", default=os.environ.get("APP_BIND", "127.0.0.1:8050"), help="host:port to listen on")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("APP_WORKERS", 0)) or None,
+                        help="worker processes, the number of CPUs by default")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("APP_THREADS", 4)), help="threads per worker")
+    parser.add_argument("--timeout", type=int, default=120, help="seconds before a busy worker is restarted")
+    parser.add_argument("--lazy", action="store_true",
+                        help="bind right away and load the data in every worker instead of once before forking")
+    args = parser.parse_args()
+    run(bind=args.bind, workers=args.workers, threads=args.threads, timeout=args.timeout, lazy=args.lazy)
@@ -0,0 +1,207 @@
+import csv
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from tx_store import load_transactions, address_row_index, store_exists
+
+
+# transaction counts per hour, rolled up to days and months on request; the frequencies are the
+# ones of the app dropdowns, 'M' buckets are labelled with the month end as pd.Grouper does
+freqs = ['H', 'D', 'M']
+
+
+def to_hours(stamps):
+    # datetime64[ns] -> whole hours since the epoch
+    return np.asarray(stamps).astype("datetime64[h]").astype(np.int64)
+
+
+def hourly_counts(hours):
+    """
+    :return: first hour and the dense counts of every hour from the first to the last one
+    """
+    if len(hours) == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    first_hour = int(hours.min())
+    return first_hour, np.bincount(hours - first_hour)
+
+
+def rollup(first_hour, counts, freq='H'):
+    """
+    Sums dense hourly counts into hourly, daily or monthly buckets, keeping the empty ones.
+
+    :return: bucket labels as datetime64[ns] and the counts
+    """
+    assert freq in freqs, 'Invalid frequency'
+    hours = (first_hour + np.arange(len(counts))).astype("datetime64[h]")
+    if freq == 'H' or len(counts) == 0:
+        return hours.astype("datetime64[ns]"), counts
+    buckets = hours.astype(f"datetime64[{freq}]").astype(np.int64)
+    bucket_counts = np.bincount(buckets - buckets[0], weights=counts).astype(np.int64)
+    labels = (buckets[0] + np.arange(len(bucket_counts))).astype(f"datetime64[{freq}]")
+    if freq == 'M':
+        labels = (labels + 1).astype("datetime64[D]") - 1
+    return labels.astype("datetime64[ns]"), bucket_counts
+
+
+def build_time_series(hours):
+    # global counts for every frequency, computed once
+    first_hour, counts = hourly_counts(hours)
+    return {freq: rollup(first_hour, counts, freq) for freq in freqs}
+
+
+def date_slice(labels, start_date=None, end_date=None):
+    # buckets with start_date < label < end_date, by binary search on the sorted labels
+    start = 0 if start_date is None else np.searchsorted(labels, pd.Timestamp(start_date).to_datetime64(), 'right')
+    stop = len(labels) if end_date is None else np.searchsorted(labels, pd.Timestamp(end_date).to_datetime64(), 'left')
+    return slice(int(start), int(max(start, stop)))
+
+
+def minmax_downsample(x, y, max_points=2000):
+    """
+    Reduces a series to at most max_points points by keeping the minimum and maximum of each of
+    max_points / 2 equal buckets (and the end points), so spikes survive at any zoom level.
+    """
+    n = len(y)
+    if n <= max_points:
+        return x, y
+    n_buckets = max(max_points // 2 - 1, 1)
+    edges = np.linspace(0, n, n_buckets + 1).astype(np.int64)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    # within each bucket the order is by value, so its first and last positions are the min and max
+    order = np.lexsort((y, bucket))
+    keep = np.unique(np.concatenate([order[edges[:-1]], order[edges[1:] - 1], [0, n - 1]]))
+    return x[keep], y[keep]
+
+
+def build_address_cube(hours, indptr, rows):
+    """
+    Sparse hourly counts per address from a row index (see tx_store.address_row_index): the
+    hours with transactions of address code c are hour[ptr[c]:ptr[c + 1]], with their counts in count.
+
+    :param hours: hour of every transaction row, see to_hours
+    """
+    num_codes = len(indptr) - 1
+    if len(rows) == 0:
+        return {'ptr': np.zeros(num_codes + 1, dtype=np.int64), 'hour': np.zeros(0, dtype=np.int64),
+                'count': np.zeros(0, dtype=np.int64)}
+    row_hours = hours[rows]
+    first_hour = int(row_hours.min())
+    span = int(row_hours.max()) - first_hour + 1
+    keys = np.repeat(np.arange(num_codes, dtype=np.int64), np.diff(indptr)) * span + (row_hours - first_hour)
+    # rows are grouped by address and in row order, so the keys are already sorted on a sorted store
+    if (keys[1:] < keys[:-1]).any():
+        keys = np.sort(keys)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    keys = keys[starts]
+    return {'ptr': np.searchsorted(keys, np.arange(num_codes + 1, dtype=np.int64) * span),
+            'hour': keys % span + first_hour,
+            'count': counts}
+
+
+def address_time_series(cube, code, freq='H'):
+    """
+    :return: bucket labels and counts of one address, spanning its first to last transaction;
+             empty for a None code
+    """
+    if code is None or cube['ptr'][code] == cube['ptr'][code + 1]:
+        return np.zeros(0, dtype="datetime64[ns]"), np.zeros(0, dtype=np.int64)
+    start, stop = cube['ptr'][code], cube['ptr'][code + 1]
+    first_hour = int(cube['hour'][start])
+    counts = np.bincount(cube['hour'][start:stop] - first_hour, weights=cube['count'][start:stop]).astype(np.int64)
+    return rollup(first_hour, counts, freq)
+
+
+def build_fingerprints(cube):
+    """
+    24-hour and 7-day activity histograms of every address in one pass over an address cube.
+
+    :return: dict with hourly (num_codes x 24) and weekly (num_codes x 7, Monday first) int32 counts
+    """
+    num_codes = len(cube['ptr']) - 1
+    codes = np.repeat(np.arange(num_codes, dtype=np.int64), np.diff(cube['ptr']))
+    days = cube['hour'] // 24
+    fingerprints = {}
+    for name, bins, key in [('hourly', 24, cube['hour'] % 24), ('weekly', 7, (days + 3) % 7)]:  # 1970-01-01 is a Thursday
+        counts = np.bincount(codes * bins + key, weights=cube['count'], minlength=num_codes * bins)
+        fingerprints[name] = counts.reshape(num_codes, bins).astype(np.int32)
+    return fingerprints
+
+
+def fingerprint_profiles(fingerprints):
+    # hourly and weekly shares of each address's transactions, scaled to unit length for cosine similarity
+    profiles = []
+    for name in ['hourly', 'weekly']:
+        counts = fingerprints[name].astype(np.float32)
+        profiles.append(counts / np.maximum(counts.sum(axis=1, keepdims=True), 1))
+    profiles = np.concatenate(profiles, axis=1)
+    return profiles / np.maximum(np.linalg.norm(profiles, axis=1, keepdims=True), 1e-12)
+
+
+def similar_fingerprints(fingerprints, codes, top_k=10, min_count=10, block_size=64, profiles=None):
+    """
+    Addresses with the most similar hourly and weekly activity (cosine similarity of the
+    normalized histograms), for many query codes at once. Only addresses with at least min_count
+    transactions are candidates.
+
+    :return: candidate codes and similarities, both len(codes) x top_k, best first
+    """
+    profiles = fingerprint_profiles(fingerprints) if profiles is None else profiles
+    candidates = np.flatnonzero(fingerprints['hourly'].sum(axis=1) >= min_count)
+    candidate_profiles = profiles[candidates]
+    codes = np.asarray(codes, dtype=np.int64)
+    k = min(top_k, max(len(candidates) - 1, 0))
+
+    top_codes = np.empty((len(codes), k), dtype=np.int64)
+    top_sims = np.empty((len(codes), k), dtype=np.float32)
+    for start in range(0, len(codes), block_size):
+        block = codes[start:start + block_size]
+        sims = profiles[block] @ candidate_profiles.T
+        sims[candidates[None, :] == block[:, None]] = -np.inf  # exclude the query itself
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k] if k > 0 else np.empty((len(block), 0), dtype=np.int64)
+        top_sim = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sim, axis=1, kind="stable")
+        top_codes[start:start + block_size] = candidates[np.take_along_axis(top, order, axis=1)]
+        top_sims[start:start + block_size] = np.take_along_axis(top_sim, order, axis=1)
+    return top_codes, top_sims
+
+
+def load_activity():
+    # hour of every transaction and the per-address row index, without decoding the addresses on a store
+    columns = ['block_timestamp'] if store_exists() else ['from_address', 'to_address', 'block_timestamp']
+    data = load_transactions(columns)
+    return to_hours(data['block_timestamp'].values), address_row_index(data)
+
+
+def load_fingerprints(direction='out'):
+    # fingerprints of the sent ('out') or received ('in') transactions of the whole store
+    hours, index = load_activity()
+    cube = build_address_cube(hours, index[f'{direction}_indptr'], index[f'{direction}_rows'])
+    return build_fingerprints(cube), index['address_to_code']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Addresses with similar hourly and weekly activity")
+    parser.add_argument("input_path", help="text file with one address per line")
+    parser.add_argument("output_path", help="csv file with query_addr, rank, cand_addr, similarity")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--min-count", type=int, default=10, help="minimum transactions of a candidate")
+    args = parser.parse_args()
+
+    with open(args.input_path, "r") as f:
+        query_addresses = [line.strip() for line in f if line.strip()]
+    fingerprints, address_to_code = load_fingerprints()
+    code_to_address = {code: address for address, code in address_to_code.items()}
+    known = [address for address in query_addresses if address in address_to_code]
+    print(f"{len(query_addresses) - len(known)} of {len(query_addresses)} addresses have no transactions")
+
+    top_codes, top_sims = similar_fingerprints(fingerprints, [address_to_code[a] for a in known],
+                                               args.top_k, args.min_count)
+    with open(args.output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["query_addr", "rank", "cand_addr", "similarity"])
+        for address, codes, sims in tqdm(zip(known, top_codes, top_sims), total=len(known)):
+            for rank, (code, sim) in enumerate(zip(codes, sims)):
+                writer.writerow([address, rank + 1, code_to_address[code], f"{sim:.6f}"])
@@ -0,0 +1,357 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+cur_dir = os.path.dirname(__file__)
+store_dir = os.path.join(cur_dir, "data", "eth_store")
+csv_path = os.path.join(cur_dir, "data", "eth_data.csv")
+
+# on-disk layout: one raw little-endian file per column plus meta.json; addresses are
+# dictionary-encoded into int32 codes and block_timestamp holds datetime64[ns] as int64
+column_dtypes = {
+    'hash': None,  # fixed-width bytes, width recorded in meta.json
+    'block_number': '<f8',
+    'transaction_index': '<f8',
+    'from_address': '<i4',
+    'to_address': '<i4',
+    'value': '<f8',
+    'gas': '<f8',
+    'gas_price': '<f8',
+    'block_timestamp': '<i8',
+}
+address_columns = ['from_address', 'to_address']
+
+
+def store_exists(path=store_dir):
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def load_meta(path=store_dir):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def save_meta(meta, path=store_dir):
+    tmp_path = os.path.join(path, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+
+def data_version(path=store_dir):
+    # changes whenever transactions are added
+    if store_exists(path):
+        meta = load_meta(path)
+        return f"{meta['num_rows']}-{meta['min_timestamp']}-{meta['max_timestamp']}"
+    return str(os.path.getmtime(csv_path))
+
+
+def load_dictionary(path=store_dir):
+    return np.load(os.path.join(path, "addresses.npy"))
+
+
+def load_column(name, path=store_dir, meta=None, mmap=True):
+    meta = meta if meta is not None else load_meta(path)
+    dtype = np.dtype(meta["columns"][name])
+    col_path = os.path.join(path, f"{name}.bin")
+    if meta["num_rows"] == 0:
+        return np.empty(0, dtype=dtype)
+    if mmap:
+        return np.memmap(col_path, dtype=dtype, mode="r", shape=(meta["num_rows"],))
+    return np.fromfile(col_path, dtype=dtype, count=meta["num_rows"])
+
+
+def row_range(start_date=None, end_date=None, path=store_dir, meta=None):
+    """
+    Returns the [start, stop) row positions of the transactions with start_date <= block_timestamp
+    < end_date, using binary search on the timestamp column. Only valid on a sorted store.
+    """
+    meta = meta if meta is not None else load_meta(path)
+    stamps = load_column('block_timestamp', path, meta)
+    start = 0 if start_date is None else int(np.searchsorted(stamps, pd.Timestamp(start_date).value, side='left'))
+    stop = len(stamps) if end_date is None else int(np.searchsorted(stamps, pd.Timestamp(end_date).value, side='left'))
+    return start, max(start, stop)
+
+
+def timestamp_range(path=store_dir):
+    # first and last block_timestamp, read from meta.json when there is a store
+    if store_exists(path):
+        meta = load_meta(path)
+        return pd.Timestamp(meta["min_timestamp"]), pd.Timestamp(meta["max_timestamp"])
+    stamps = load_transactions(['block_timestamp'], path=path)["block_timestamp"]
+    return stamps.min(), stamps.max()
+
+
+def sorted_runs(stamps, offset=0):
+    """
+    Splits a timestamp column into runs of ascending timestamps.
+
+    :return: list of [start_row, stop_row, first_timestamp, last_timestamp], rows counted from offset
+    """
+    stamps = np.asarray(stamps)
+    if len(stamps) == 0:
+        return []
+    breaks = np.flatnonzero(stamps[1:] < stamps[:-1]) + 1
+    starts, stops = np.r_[0, breaks], np.r_[breaks, len(stamps)]
+    return [[offset + int(start), offset + int(stop), int(stamps[start]), int(stamps[stop - 1])]
+            for start, stop in zip(starts, stops)]
+
+
+def store_runs(path=store_dir, meta=None):
+    # stores written before the runs were recorded get them from the timestamp column
+    meta = meta if meta is not None else load_meta(path)
+    if "runs" in meta:
+        return meta["runs"]
+    return sorted_runs(load_column('block_timestamp', path, meta))
+
+
+def time_rows(start_date=None, end_date=None, path=store_dir, meta=None):
+    """
+    Row positions of the transactions with start_date <= block_timestamp < end_date, by binary
+    search in each sorted run: a slice when the store is one run, an index array otherwise.
+    """
+    meta = meta if meta is not None else load_meta(path)
+    runs = store_runs(path, meta)
+    if len(runs) <= 1:
+        return slice(*row_range(start_date, end_date, path, meta))
+    start_value = None if start_date is None else pd.Timestamp(start_date).value
+    end_value = None if end_date is None else pd.Timestamp(end_date).value
+    stamps = load_column('block_timestamp', path, meta)
+    pieces = []
+    for start, stop, first, last in runs:
+        if (end_value is not None and end_value <= first) or (start_value is not None and start_value > last):
+            continue
+        run_stamps = stamps[start:stop]
+        lo = start if start_value is None else start + int(np.searchsorted(run_stamps, start_value, side='left'))
+        hi = stop if end_value is None else start + int(np.searchsorted(run_stamps, end_value, side='left'))
+        if lo < hi:
+            pieces.append(np.arange(lo, hi))
+    return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.int64)
+
+
+def find_hashes(hashes, stamps, path=store_dir, meta=None):
+    """
+    Marks the transactions that are already in the store. Only the rows within the time range of
+    stamps are compared, found by binary search in each sorted run of the store (see sorted_runs),
+    so batches appended out of time order do not make it scan the whole store.
+
+    :param stamps: block_timestamp of each hash
+    :return: boolean array aligned with hashes
+    """
+    meta = meta if meta is not None else load_meta(path)
+    hashes = np.asarray(hashes).astype(meta["columns"]["hash"])
+    found = np.zeros(len(hashes), dtype=bool)
+    if meta["num_rows"] == 0 or len(hashes) == 0:
+        return found
+    stamps = np.asarray(stamps).astype("datetime64[ns]").astype(np.int64)
+    first, last = stamps.min(), stamps.max()
+    all_stamps = load_column('block_timestamp', path, meta)
+    all_hashes = load_column('hash', path, meta)
+    for start, stop, run_first, run_last in store_runs(path, meta):
+        if run_last < first or run_first > last:
+            continue
+        run_stamps = all_stamps[start:stop]
+        lo = start + int(np.searchsorted(run_stamps, first, side='left'))
+        hi = start + int(np.searchsorted(run_stamps, last, side='right'))
+        found |= np.isin(hashes, np.asarray(all_hashes[lo:hi]))
+    return found
+
+
+def load_transactions(columns=None, decode_addresses=True, path=store_dir, start_date=None, end_date=None):
+    """
+    Loads the transaction table, reading only the requested columns.
+
+    :param columns: column names to load, all columns if None
+    :param decode_addresses: map address codes back to strings, otherwise keep int32 codes
+    :param path: store directory, falls back to data/eth_data.csv if no store exists there
+    :param start_date: keep rows with block_timestamp >= start_date
+    :param end_date: keep rows with block_timestamp < end_date
+    :return: DataFrame with block_timestamp as datetime64[ns]
+    """
+    if columns is None:
+        columns = list(column_dtypes.keys())
+    columns = list(columns)
+    clip = start_date is not None or end_date is not None
+
+    if not store_exists(path):
+        usecols = columns + (['block_timestamp'] if clip and 'block_timestamp' not in columns else [])
+        data_df = pd.read_csv(csv_path, index_col=0, usecols=['Unnamed: 0'] + usecols,
+                              parse_dates=["block_timestamp"] if 'block_timestamp' in usecols else False)
+        data_df.index.name = None
+        if clip:
+            mask = np.ones(len(data_df), dtype=bool)
+            if start_date is not None:
+                mask &= (data_df["block_timestamp"] >= pd.Timestamp(start_date)).values
+            if end_date is not None:
+                mask &= (data_df["block_timestamp"] < pd.Timestamp(end_date)).values
+            data_df = data_df.loc[mask]
+        return data_df[columns]
+
+    meta = load_meta(path)
+    rows = time_rows(start_date, end_date, path, meta) if clip else slice(None)
+
+    dictionary = load_dictionary(path) if decode_addresses else None
+    data = {}
+    for name in columns:
+        col = np.asarray(load_column(name, path, meta)[rows])
+        if name == 'block_timestamp':
+            col = col.view("datetime64[ns]")
+        elif name == 'hash':
+            col = col.astype(str)
+        elif name in address_columns and decode_addresses:
+            col = dictionary[col].astype(str)
+        data[name] = col
+    return pd.DataFrame(data, columns=columns)
+
+
+def build_row_index(codes, num_codes):
+    # rows of code c are rows[indptr[c]:indptr[c + 1]], in row order
+    indptr = np.zeros(num_codes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=num_codes), out=indptr[1:])
+    return indptr, np.argsort(codes, kind="stable")
+
+
+def address_row_index(data_df=None, path=store_dir):
+    """
+    Index of the transactions sent ('out') and received ('in') by every address, over the rows
+    of the full table as returned by load_transactions.
+
+    :param data_df: transactions with decoded addresses, only used when there is no store
+    :return: dict with out_indptr, out_rows, in_indptr, in_rows and address_to_code
+    """
+    if store_exists(path):
+        meta = load_meta(path)
+        codes = {name: np.asarray(load_column(name, path, meta)) for name in address_columns}
+        dictionary = load_dictionary(path).astype(str)
+    else:
+        stacked, dictionary = pd.factorize(np.concatenate([data_df[name].values for name in address_columns]))
+        codes = dict(zip(address_columns, np.split(stacked.astype(np.int32), 2)))
+
+    index = {'address_to_code': {address: code for code, address in enumerate(dictionary)}}
+    for prefix, name in [('out', 'from_address'), ('in', 'to_address')]:
+        index[f'{prefix}_indptr'], index[f'{prefix}_rows'] = build_row_index(codes[name], len(dictionary))
+    return index
+
+
+class StoreWriter:
+    """
+    Appends DataFrames of parsed transactions (as produced by create_data.parse_chunk) to a store.
+
+    The address dictionary is kept in memory while writing and flushed on close. Opening an
+    existing store appends to it; new addresses get codes after the existing ones.
+
+    Rows are only part of the store once close() has written meta.json. Used as a context
+    manager, an exception drops the rows appended since opening, and opening a store drops rows
+    left behind by an interrupted writer.
+    """
+
+    def __init__(self, path=store_dir, overwrite=False, hash_width=66):
+        self.path = path
+        if overwrite or not store_exists(path):
+            os.makedirs(path, exist_ok=True)
+            for name in column_dtypes:
+                open(os.path.join(path, f"{name}.bin"), "wb").close()
+            columns = dict(column_dtypes, hash=f"S{hash_width}")
+            self.meta = {"num_rows": 0, "num_addresses": 0, "sorted": True, "columns": columns,
+                         "min_timestamp": None, "max_timestamp": None, "runs": []}
+            self.dictionary = []
+        else:
+            self.meta = load_meta(path)
+            self.dictionary = load_dictionary(path).astype(str).tolist()
+            self.truncate(self.meta["num_rows"])
+            self.meta["runs"] = store_runs(path, self.meta)
+        self.committed_rows = self.meta["num_rows"]
+        self.addr2code = {addr: code for code, addr in enumerate(self.dictionary)}
+        self.num_new_addresses = 0
+
+    def encode(self, addresses):
+        uniques, inverse = np.unique(np.asarray(addresses, dtype=str), return_inverse=True)
+        codes = np.empty(len(uniques), dtype=np.int32)
+        for i, addr in enumerate(uniques):
+            code = self.addr2code.get(addr)
+            if code is None:
+                code = len(self.dictionary)
+                self.addr2code[addr] = code
+                self.dictionary.append(addr)
+                self.num_new_addresses += 1
+            codes[i] = code
+        return codes[inverse.reshape(-1)]
+
+    def truncate(self, num_rows):
+        # cuts every column file back to num_rows rows
+        for name, dtype in self.meta["columns"].items():
+            with open(os.path.join(self.path, f"{name}.bin"), "r+b") as f:
+                f.truncate(num_rows * np.dtype(dtype).itemsize)
+
+    def append(self, data_df):
+        if len(data_df) == 0:
+            return
+        stamps = data_df["block_timestamp"].values.astype("datetime64[ns]").astype(np.int64)
+        # every column is converted before any is written, so a bad row fails the batch up front
+        cols = {}
+        for name, dtype in self.meta["columns"].items():
+            if name in address_columns:
+                col = self.encode(data_df[name].values)
+            elif name == 'block_timestamp':
+                col = stamps
+            elif name == 'hash':
+                col = data_df[name].values.astype(dtype)
+            else:
+                col = data_df[name].values
+            cols[name] = np.ascontiguousarray(col, dtype=dtype)
+        try:
+            for name, col in cols.items():
+                with open(os.path.join(self.path, f"{name}.bin"), "ab") as f:
+                    col.tofile(f)
+        except BaseException:
+            self.truncate(self.meta["num_rows"])
+            raise
+
+        runs = self.meta["runs"]
+        for run in sorted_runs(stamps, offset=self.meta["num_rows"]):
+            # a run continuing the last one in time extends it
+            if runs and runs[-1][1] == run[0] and runs[-1][3] <= run[2]:
+                runs[-1][1], runs[-1][3] = run[1], run[3]
+            else:
+                runs.append(run)
+        self.meta["sorted"] = len(runs) <= 1
+        if self.meta["min_timestamp"] is None or stamps.min() < self.meta["min_timestamp"]:
+            self.meta["min_timestamp"] = int(stamps.min())
+        if self.meta["max_timestamp"] is None or stamps.max() > self.meta["max_timestamp"]:
+            self.meta["max_timestamp"] = int(stamps.max())
+        self.meta["num_rows"] += len(data_df)
+
+    def sort_dictionary(self, chunksize=10_000_000):
+        # reorder codes so that code == position in the sorted address list, i.e. the address id
+        dictionary = np.array(self.dictionary, dtype=str)
+        order = np.argsort(dictionary, kind="stable")
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        if self.meta["num_rows"] > 0:
+            for name in address_columns:
+                codes = np.memmap(os.path.join(self.path, f"{name}.bin"), dtype='<i4', mode="r+",
+                                  shape=(self.meta["num_rows"],))
+                for start in range(0, len(codes), chunksize):
+                    codes[start:start + chunksize] = rank[codes[start:start + chunksize]]
+                codes.flush()
+                del codes
+        self.dictionary = dictionary[order].tolist()
+        self.addr2code = {addr: code for code, addr in enumerate(self.dictionary)}
+
+    def close(self):
+        dictionary = np.array(self.dictionary, dtype=bytes) if self.dictionary else np.empty(0, dtype="S42")
+        np.save(os.path.join(self.path, "addresses.npy"), dictionary)
+        self.meta["num_addresses"] = len(self.dictionary)
+        save_meta(self.meta, self.path)
+        self.committed_rows = self.meta["num_rows"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.truncate(self.committed_rows)
@@ -0,0 +1,98 @@
+import os
+import glob
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from create_data import read_chunks, parse_chunk
+from create_graph import (update_addresses, aggregate_edges, update_edge_partitions, partitions_current,
+                          save_partition_meta)
+from tx_store import StoreWriter, store_dir, store_exists, load_meta, find_hashes
+from adjacency import adjacency_exists, load_adjacency, load_or_build_adjacency, merge_adjacency, save_adjacency, adjacency_path
+
+
+cur_dir = os.path.dirname(__file__)
+
+
+def run(batch_path, chunksize=1_000_000):
+    """
+    Adds a batch of raw transactions (same format as the full dump) without rebuilding:
+    the rows are appended to the store, unseen addresses are appended to address_data.csv with
+    new ids, and the batch edges are merged into the edge partitions and into the adjacency index
+    of every data/edges_{start}_{end}.csv window.
+
+    The store only takes the batch if it is added whole, and a batch with transactions that are
+    already in the store is rejected, so running an update twice does not count it twice.
+
+    The edges csv files are left as built; once a window has been updated its adjacency index
+    (which the app and plot_graph.py read first) holds its current edges.
+    """
+    if not store_exists():
+        raise RuntimeError("The transaction store is not found, run create_data.py first.")
+
+    address_data_path = os.path.join(cur_dir, "data", "address_data.csv")
+    address_df = pd.read_csv(address_data_path, index_col='id')
+
+    # partitions of an older store or address table are left for create_graph.py to rebuild
+    partition_freqs = []
+    for partition_path in glob.glob(os.path.join(cur_dir, "data", "edge_parts_*")):
+        freq = os.path.basename(partition_path)[len("edge_parts_"):]
+        if partitions_current(address_df, freq):
+            partition_freqs.append(freq)
+        else:
+            print(f"Skipping the outdated edge partitions {os.path.basename(partition_path)}")
+
+    start_time = time.time()
+    batch_list = []
+    meta = load_meta()
+    with StoreWriter(store_dir) as writer:
+        for chunk in tqdm(read_chunks(batch_path, chunksize), desc="Appending"):
+            # rows are ordered by the epoch, the local time of parse_chunk repeats an hour when DST ends
+            chunk = parse_chunk(chunk.sort_values("block_timestamp", kind="stable"))
+            num_stored = find_hashes(chunk["hash"].values, chunk["block_timestamp"].values, meta=meta).sum()
+            if num_stored > 0:
+                raise RuntimeError(f"{num_stored} transactions of {batch_path} are already in the store, "
+                                   f"the batch was not added.")
+            writer.append(chunk)
+            batch_list.append(chunk[['from_address', 'to_address', 'value', 'block_timestamp']])
+    batch_df = pd.concat(batch_list, ignore_index=True)
+
+    num_addresses = len(address_df)
+    address_df = update_addresses(address_df, np.concatenate([batch_df["from_address"].values,
+                                                              batch_df["to_address"].values]))
+    address_df.iloc[num_addresses:].to_csv(address_data_path, mode="a", header=False)
+    print(f"{len(address_df) - num_addresses} new addresses")
+
+    # only the addresses of the batch are needed to map it to ids
+    batch_addresses = address_df.loc[address_df["address"].isin(set(batch_df["from_address"]) |
+                                                                 set(batch_df["to_address"]))]
+    for freq in partition_freqs:
+        update_edge_partitions(batch_df, batch_addresses, freq=freq)
+        save_partition_meta(address_df, freq)
+
+    for edges_data_path in glob.glob(os.path.join(cur_dir, "data", "edges_*_*.csv")):
+        start_date, end_date = os.path.basename(edges_data_path)[len("edges_"):-len(".csv")].split("_")
+        window_df = batch_df.loc[(batch_df["block_timestamp"] >= pd.to_datetime(start_date)) &
+                                 (batch_df["block_timestamp"] < pd.to_datetime(end_date))]
+        if len(window_df) == 0:
+            continue
+        adj_path = adjacency_path(start_date, end_date)
+        if adjacency_exists(adj_path):
+            adj = load_adjacency(adj_path)
+        else:  # first update of the window, its index is built once from the csv
+            adj = load_or_build_adjacency(pd.read_csv(edges_data_path, index_col=0), adj_path)
+        adj, changed = merge_adjacency(adj, aggregate_edges(window_df, batch_addresses),
+                                       num_nodes=int(address_df.index.max()) + 1)
+        save_adjacency(adj, adj_path, changed)
+        print(f"Updated the {start_date}_{end_date} adjacency index with {len(window_df)} transactions")
+
+    print(f"Added {len(batch_df)} rows in {time.time() - start_time:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Append a batch of transactions to the existing data")
+    parser.add_argument("batch_path", help="csv file in the phishing_deanony_2hop_transaction.csv format")
+    args = parser.parse_args()
+    run(args.batch_path)